@@ -0,0 +1,81 @@
+import random
+import time
+
+import numpy as np
+
+from chess_standard.board_chess_pypi import UCI_ARRAY, BoardPypiChess
+
+# Times BoardPypiChess.move_from_int against the FEN round trip it replaced, in boards/sec.
+# Every legal child of a set of positions is built, as get_board does when a search expands
+# them, with and without computing each child's legal mask afterwards.
+
+
+def fen_move_from_int(board: BoardPypiChess, num: int) -> BoardPypiChess:
+    """The old move_from_int: push, write the FEN, pop, parse it and compute the mask"""
+    move_uci = UCI_ARRAY[num]
+    if not board.white_move:
+        move_uci = board.flip_uci(move_uci)
+    board.board.push_uci(move_uci)
+    fen = board.board.fen()
+    board.board.pop()
+    child = BoardPypiChess(fen=fen)
+    child.legal_moves()
+    return child
+
+
+def copy_move_from_int(board: BoardPypiChess, num: int) -> BoardPypiChess:
+    return board.move_from_int(num)
+
+
+METHODS = {"fen": fen_move_from_int, "copy": copy_move_from_int}
+
+
+def positions(plies: int, count: int, seed: int = 0) -> list:
+    """count positions reached by random moves from the start, plies deep when possible"""
+    rng = random.Random(seed)
+    boards = []
+    for _ in range(count):
+        board = BoardPypiChess.from_start()
+        for _ in range(plies):
+            legal = np.flatnonzero(board.legal_moves())
+            if len(legal) == 0 or board.board.is_game_over():
+                break
+            board = board.move_from_int(int(rng.choice(legal)))
+        boards.append(board)
+    return boards
+
+
+def boards_per_sec(method, boards: list, with_mask: bool) -> float:
+    moves = [np.flatnonzero(board.legal_moves()) for board in boards]
+    built = 0
+    st = time.time()
+    for board, legal in zip(boards, moves):
+        for move in legal:
+            child = method(board, int(move))
+            if with_mask:
+                child.legal_moves()
+            built += 1
+    return built / (time.time() - st)
+
+
+if __name__ == "__main__":
+    PLIES = [0, 40, 150]
+    POSITIONS = 20
+
+    for plies in PLIES:
+        boards = positions(plies, POSITIONS)
+        stack = np.mean([len(board.board.move_stack) for board in boards])
+        for with_mask in [False, True]:
+            rates = {
+                name: boards_per_sec(method, boards, with_mask)
+                for name, method in METHODS.items()
+            }
+            print(
+                f"plies={plies:>3} (stack {np.round(stack, 1)}) "
+                f"{'with mask' if with_mask else 'no mask  '}: "
+                + ", ".join(
+                    f"{name} {np.round(rate)} boards/sec"
+                    for name, rate in rates.items()
+                )
+                + f", speedup {np.round(rates['copy'] / rates['fen'], 2)}x"
+            )
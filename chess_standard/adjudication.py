@@ -0,0 +1,91 @@
+from collections import Counter
+
+import chess
+
+PIECE_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+}
+
+MATERIAL_MARGIN = 5  # pawns of material lead that decide a game without the engine
+
+
+def result_for(color: chess.Color) -> int:
+    return 1 if color == chess.WHITE else -1
+
+
+def insufficient_material(board: chess.Board):
+    if board.is_insufficient_material():
+        return 0
+    return None
+
+
+def game_over(board: chess.Board):
+    outcome = board.outcome()
+    if outcome is None:
+        return None
+    return 0 if outcome.winner is None else result_for(outcome.winner)
+
+
+def mate_in_one(board: chess.Board):
+    for move in board.legal_moves:
+        board.push(move)
+        mate = board.is_checkmate()
+        board.pop()
+        if mate:
+            return result_for(board.turn)
+    return None
+
+
+def material(board: chess.Board) -> int:
+    """White's material lead in pawns, counted from the piece bitboards"""
+    lead = 0
+    for piece, value in PIECE_VALUES.items():
+        white = chess.popcount(board.pieces_mask(piece, chess.WHITE))
+        black = chess.popcount(board.pieces_mask(piece, chess.BLACK))
+        lead += value * (white - black)
+    return lead
+
+
+def material_imbalance(board: chess.Board):
+    lead = material(board)
+    if abs(lead) >= MATERIAL_MARGIN:
+        return 1 if lead > 0 else -1
+    return None
+
+
+# cheapest first; each returns the result from white's side, or None to escalate
+TIERS = [
+    ("insufficient_material", insufficient_material),
+    ("game_over", game_over),
+    ("mate_in_one", mate_in_one),
+    ("material_imbalance", material_imbalance),
+]
+
+TIER_COUNTS = Counter()  # tier -> positions it settled, "engine" for the rest
+
+
+def adjudicate(board: chess.Board, engine) -> int:
+    """
+    Settles a game stopped at the move limit with the first of TIERS that can, or
+    with engine() if none of them do
+    """
+    for name, tier in TIERS:
+        result = tier(board)
+        if result is not None:
+            TIER_COUNTS[name] += 1
+            return result
+    TIER_COUNTS["engine"] += 1
+    return engine()
+
+
+def tier_stats() -> dict:
+    """The positions each tier settled, and the fraction kept away from the engine"""
+    total = sum(TIER_COUNTS.values())
+    return {
+        "tiers": dict(TIER_COUNTS),
+        "engine_avoided": 1 - TIER_COUNTS["engine"] / total if total > 0 else 0.0,
+    }
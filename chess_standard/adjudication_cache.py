@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+
+
+class AdjudicationCache:
+    def __init__(self, path: str = None):
+        """
+        Engine scores kept in a SQLite file at path, so every worker process and every
+        later run can reuse them. Without a path they are kept in memory, by each
+        process on its own, until relocate gives one.
+
+        Keys are strings naming the position and the search that scored it, see
+        EnginePool.evaluate. The file is opened lazily, once per process, in WAL mode so
+        readers never wait on a writer. hits and misses count this process's lookups.
+        """
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None  # connections do not cross into another process
+        state["lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def fork_check(self):
+        """A forked child opens its own connection rather than sharing its parent's"""
+        if self.pid != os.getpid():
+            self.connection = None
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+            self.hits = 0
+            self.misses = 0
+
+    def relocate(self, path: str):
+        """Uses the file at path from now on, the scores kept so far staying behind"""
+        self.fork_check()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            self.path = path
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.path or ":memory:", timeout=30, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def lookup(self, key: str):
+        self.fork_check()
+        with self.lock:
+            row = (
+                self.connect()
+                .execute("SELECT score FROM scores WHERE key = ?", (key,))
+                .fetchone()
+            )
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def store(self, key: str, score: float):
+        self.fork_check()
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR IGNORE INTO scores VALUES (?, ?)", (key, float(score))
+            )
+            connection.commit()
+
+    def __len__(self):
+        self.fork_check()
+        with self.lock:
+            if self.connection is None and not self.exists():
+                return 0  # nothing stored yet, and counting should not create the file
+            return self.connect().execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def exists(self) -> bool:
+        return self.path is not None and os.path.exists(self.path)
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+        }
@@ -1,10 +1,14 @@
+import os
 import numpy as np
 import chess
+import chess.polyglot
 
 import torch
-import requests
 from common.board import BlankBoard
-from stockfish import Stockfish
+from chess_standard.adjudication import adjudicate, tier_stats
+from chess_standard.adjudication_cache import AdjudicationCache
+from chess_standard.engine_pool import EnginePool
+from chess_standard.stockfish_online import StockfishOnline
 
 UCI_ARRAY = ["a1b1",  "a1c1",  "a1d1",  "a1e1",  "a1f1",  "a1g1",  "a1h1",  "a1a2",
     "a1b2",  "a1c2",  "a1a3",  "a1b3",  "a1c3",  "a1a4",  "a1d4",  "a1a5",
@@ -249,31 +253,87 @@ UCI_MAP = {s: i for i, s in enumerate(UCI_ARRAY)}
 
 STOP_AT = 100
 
-STOCKFISH_PATH = "stockfish" # MAC M2
+PLY_KEY = 0x9E3779B97F4A7C15  # mixed into zobrist_hash so repeated positions differ by ply
+
+STOCKFISH_PATH = os.environ.get("STOCKFISH_PATH", "stockfish") # MAC M2
 # STOCKFISH_PATH = "/home/jovyan/work/MANTIS/stockfish-ubuntu16" #Jupyter Lab Container
 # STOCKFISH_PATH = "/hpc/home/ash98/MANTIS/stockfish-ubuntu16"
 
+ADJUDICATION_BACKEND = os.environ.get("ADJUDICATION_BACKEND", "local")  # "online" asks STOCKFISH_ONLINE, in batches, instead of ENGINE_POOL
+
+STOCKFISH_ONLINE = StockfishOnline(os.environ.get("STOCKFISH_API", "https://stockfish.online/api/s/v2.php"))
+
+ADJUDICATION_DB = os.environ.get("ADJUDICATION_DB")  # one file for every process and run; unset, use_save_dir puts it in the save directory
+
+ADJUDICATION_FILE = "adjudications.db"  # name of the cache inside a training run's save directory
+
+ADJUDICATION_CACHE = AdjudicationCache(ADJUDICATION_DB)
+
+ENGINE_POOL_SIZE = int(os.environ.get("ENGINE_POOL_SIZE", 4))  # engines per process
+ENGINE_DEPTH = int(os.environ.get("ENGINE_DEPTH", 15))
+ENGINE_NODES = int(os.environ["ENGINE_NODES"]) if "ENGINE_NODES" in os.environ else None  # node limit per position, on top of the depth
+ENGINE_THREADS = int(os.environ.get("ENGINE_THREADS", 1))
+ENGINE_HASH_MB = int(os.environ.get("ENGINE_HASH_MB", 16))
+
+ENGINE_POOL = EnginePool(
+    STOCKFISH_PATH,
+    size=ENGINE_POOL_SIZE,
+    depth=ENGINE_DEPTH,
+    nodes=ENGINE_NODES,
+    threads=ENGINE_THREADS,
+    hash_mb=ENGINE_HASH_MB,
+    cache=ADJUDICATION_CACHE,
+)  # engines start on the first adjudication
+
 class BoardPypiChess(BlankBoard):
-    def __init__(self, fen=""):
+    def __init__(self, fen="", board: chess.Board = None):
         """
         Initializes the chess board and all the included internal information from the chess.Board() class
+
+        board, if given, is used as is instead of parsing fen
         """
-        if fen:
+        if board is not None:
+            self.board = board
+        elif fen:
             self.board = chess.Board(fen)
         else:
             self.board = chess.Board()
         self.white_move = self.board.turn
-        self.all_legal_moves = self.legal_moves()
+        self.legal_mask = None  # legal_moves, once computed
+        self.terminal = None  # terminal_eval, once computed
 
     @classmethod
     def from_start(cls):
         return cls()
+
+    @classmethod
+    def adjudication_stats(cls) -> dict:
+        return {**ADJUDICATION_CACHE.stats(), **tier_stats()}
+
+    @classmethod
+    def use_save_dir(cls, save_dir: str):
+        """Keeps the adjudication cache in save_dir, unless ADJUDICATION_DB names a file"""
+        if ADJUDICATION_DB is None:
+            ADJUDICATION_CACHE.relocate(os.path.join(save_dir, ADJUDICATION_FILE))
     
     def flip_uci(self, uci):
         return uci[0] + str(9-int(uci[1])) + uci[2] + str(9 - int(uci[3])) + uci[4:]
 
+    @property
+    def all_legal_moves(self) -> np.ndarray:
+        return self.legal_moves()
+
     def legal_moves(self) -> np.ndarray:
-        """Returns a binary mask of length 7 for C4, OUTPUT_LENGTH for chess that represents the legal moves"""
+        """
+        Returns a binary mask of length 7 for C4, OUTPUT_LENGTH for chess that represents the legal moves
+
+        computed on first use and shared by later calls, so it must not be modified
+        """
+        if self.legal_mask is None:
+            self.legal_mask = self.legal_mask_slow()
+        return self.legal_mask
+
+    def legal_mask_slow(self) -> np.ndarray:
         legals = self.board.legal_moves
         if self.white_move:
             ucis = [m.uci() for m in legals]
@@ -285,36 +345,71 @@ class BoardPypiChess(BlankBoard):
             array[UCI_MAP[uci]] = 1
         return array
     
+    @classmethod
+    def batch_terminal_evals(cls) -> bool:
+        return ADJUDICATION_BACKEND == "online"
+
+    @classmethod
+    def terminal_evals(cls, boards) -> list:
+        """
+        terminal_eval of every board. With the online backend, the boards past STOP_AT
+        the adjudication tiers leave undecided are sent to the endpoint together.
+        """
+        if ADJUDICATION_BACKEND == "online":
+            remote = []
+            for board in boards:
+                if board.terminal is None and board.terminal_slow():
+                    board.terminal = adjudicate(board.board, lambda: None)
+                    if board.terminal is None:  # left to the engine
+                        remote.append(board)
+            if len(remote) > 0:
+                results = cls.terminate_many_from_stockfish(remote)
+                for board, result in zip(remote, results):
+                    board.terminal = result
+        return [board.terminal_eval() for board in boards]
+
     def terminate_from_stockfish(self) -> int:
-        payload = {
-            'fen': self.board.fen(),  # This is the starting position in FEN format
-            'depth': '10',  # This is the example move, you can chain moves like 'e2e4 e7e5'
-        }
-        
-        response = requests.get(url="https://stockfish.online/api/s/v2.php", params=payload)
-        if response.status_code == 200:
-            data = response.json()
-            eval = data['evaluation']
+        return self.terminate_many_from_stockfish([self])[0]
+
+    @classmethod
+    def terminate_many_from_stockfish(cls, boards) -> list:
+        """
+        terminal_eval of every board by the stockfish.online endpoint, all of them
+        requested together, e.g. the adjudications of a self-play round. Scores already
+        in the adjudication cache are not requested again. A board the endpoint never
+        answered counts as a draw.
+        """
+        keys = [
+            f"{STOCKFISH_ONLINE.url} depth {STOCKFISH_ONLINE.depth} {board.board.epd()}"
+            for board in boards
+        ]
+        scores = [ADJUDICATION_CACHE.lookup(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if len(missing) > 0:
+            found = STOCKFISH_ONLINE.evaluate([boards[i].board.fen() for i in missing])
+            for i, score in zip(missing, found):
+                scores[i] = score
+                if score is not None:  # unanswered positions are asked again next time
+                    ADJUDICATION_CACHE.store(keys[i], score)
+        results = []
+        for eval in scores:
             if eval is None:
-                return 0
-            if eval < -1:
-                return -1
-            if eval > 1:
-                return 1
-            return 0
-        else:
-            print(response)
-            print(response.status_code)
-            return 
-        
+                results.append(0)
+            elif eval < -1:
+                results.append(-1)
+            elif eval > 1:
+                results.append(1)
+            else:
+                results.append(0)
+        return results
+
+    def terminate_from_engine(self) -> int:
+        if ADJUDICATION_BACKEND == "online":
+            return self.terminate_from_stockfish()
+        return self.terminate_from_local_stockfish()
+
     def terminate_from_local_stockfish(self) -> int:
-        stockfish = Stockfish(STOCKFISH_PATH)
-        stockfish.set_fen_position(self.board.fen())
-        eval = stockfish.get_evaluation()
-        if eval['type'] == 'mate':
-            val = eval['value']
-        if eval['type'] == 'cp':
-            val = eval['value'] / 100
+        val = ENGINE_POOL.evaluate(self.board)
 
         if val <= -1:
             return -1
@@ -334,8 +429,14 @@ class BoardPypiChess(BlankBoard):
         1 : player one (white) wins
         2 : unterminated
         """
+        if self.terminal is None:
+            self.terminal = self.game_result()
+        return self.terminal
+
+    def game_result(self) -> int:
+        """terminal_eval without the memo, adjudicating past STOP_AT"""
         if self.board.fullmove_number >= STOP_AT:
-            return self.terminate_from_local_stockfish()
+            return adjudicate(self.board, self.terminate_from_engine)
 
         if self.board.is_game_over():
             outcome = self.board.outcome()
@@ -361,11 +462,11 @@ class BoardPypiChess(BlankBoard):
         else:
             move = chess.Move.from_uci(self.flip_uci(move_uci))
 
-        self.board.push(move)
-        new_board_fen = self.board.fen()
-        self.board.pop()
+        # only the moves since the last capture or pawn move can repeat a position
+        board = self.board.copy(stack=self.board.halfmove_clock)
+        board.push(move)
 
-        return BoardPypiChess(fen=new_board_fen)
+        return BoardPypiChess(board=board)
 
     def to_tensor(self) -> torch.tensor:
         """
@@ -389,6 +490,28 @@ class BoardPypiChess(BlankBoard):
 
         return torch.stack([top_layer, mid_layer, bot_layer])
 
+    def encode_into(self, out: torch.Tensor):
+        """Same encoding as to_tensor, written straight into out's three planes"""
+        if self.white_move:
+            values = self.board_to_numpy(self.board)
+            mine, theirs = values > 0, values < 0
+        else:
+            values = self.board_to_numpy(self.board.transform(chess.flip_vertical))
+            mine, theirs = values < 0, values > 0
+        pieces = np.abs(values)
+
+        planes = out.numpy()
+        np.multiply(pieces, mine, out=planes[0])
+        planes[1] = values == 0
+        np.multiply(pieces, theirs, out=planes[2])
+
+    def zobrist_hash(self) -> int:
+        """
+        Polyglot Zobrist key of the position, XORed with the ply so a repetition never
+        maps back onto an earlier node. Transpositions always share the ply.
+        """
+        ply_key = (self.board.ply() * PLY_KEY) & 0xFFFFFFFFFFFFFFFF
+        return chess.polyglot.zobrist_hash(self.board) ^ ply_key
 
     def player_perspective_eval(self) -> int:
         """
@@ -0,0 +1,204 @@
+import atexit
+import os
+import subprocess
+import threading
+from contextlib import contextmanager
+
+import chess
+from chess_standard.adjudication_cache import AdjudicationCache
+
+MATE_SCORE = 100000  # centipawns given to a forced mate
+
+
+class EngineError(Exception):
+    pass
+
+
+class UCIEngine:
+    def __init__(self, command, options: dict = None):
+        """
+        One UCI engine process, driven over its stdin and stdout
+
+        command is the binary or an argument list. options (name -> value) are only
+        set when the engine declares them.
+        """
+        command = [command] if isinstance(command, str) else list(command)
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        )
+        self.send("uci")
+        declared = set()
+        for line in self.read_until("uciok"):
+            if line.startswith("option name "):
+                declared.add(line[len("option name ") :].split(" type ")[0])
+        for name, value in (options or {}).items():
+            if name in declared:
+                self.send(f"setoption name {name} value {value}")
+        self.send("isready")
+        self.read_until("readyok")
+
+    def send(self, command: str):
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise EngineError(f"engine closed its input: {e}")
+
+    def read_until(self, token: str) -> list:
+        """returns the lines read up to and including the first starting with token"""
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if line == "":
+                raise EngineError(f"engine exited before {token}")
+            line = line.strip()
+            lines.append(line)
+            if line.startswith(token):
+                return lines
+
+    def analyse(self, board: chess.Board, depth: int = None, nodes: int = None):
+        """returns the score of board in centipawns from white's side"""
+        limits = ""
+        if depth is not None:
+            limits += f" depth {depth}"
+        if nodes is not None:
+            limits += f" nodes {nodes}"
+        self.send(f"position fen {board.fen()}")
+        self.send("go" + limits)
+
+        score = None
+        for line in self.read_until("bestmove"):
+            words = line.split()
+            if words[:1] == ["info"] and "score" in words:
+                at = words.index("score")
+                kind, value = words[at + 1], int(words[at + 2])
+                if kind == "mate":
+                    score = MATE_SCORE if value > 0 else -MATE_SCORE
+                else:
+                    score = value
+        if score is None:
+            raise EngineError(f"no score for {board.fen()}")
+        return score if board.turn == chess.WHITE else -score
+
+    def close(self):
+        try:
+            self.send("quit")
+            self.process.wait(timeout=1)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class EnginePool:
+    def __init__(
+        self,
+        command,
+        size: int = 4,
+        depth: int = 15,
+        nodes: int = None,
+        threads: int = 1,
+        hash_mb: int = 16,
+        cache: AdjudicationCache = None,
+    ):
+        """
+        Long-lived UCI engine processes, started on first use and shared by every caller
+        of the process
+
+        command is the engine binary, or an argument list such as
+        [sys.executable, "chess_standard/fake_uci_engine.py"]. At most size engines run
+        at once, each searching to depth plies and/or nodes nodes per position with
+        the given Threads and Hash (MB) options. An engine that fails is replaced by a
+        fresh one on the next checkout.
+
+        Scores found in cache skip the engine, and new ones are stored in it
+        """
+        self.command = command
+        self.size = size
+        self.depth = depth
+        self.nodes = nodes
+        self.options = {"Threads": threads, "Hash": hash_mb}
+        self.cache = cache
+
+        self.available = threading.Condition()  # notified whenever an engine frees up
+        self.idle = []
+        self.started = 0
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+    def fork_check(self):
+        """A forked child cannot share its parent's engines, so it starts its own"""
+        if self.pid != os.getpid():
+            self.available = threading.Condition()
+            self.idle = []
+            self.started = 0
+            self.pid = os.getpid()
+
+    @contextmanager
+    def engine(self):
+        """Checks an engine out for the duration of the with block"""
+        self.fork_check()
+        with self.available:
+            # a discarded engine frees its slot, so waiters may start a replacement
+            while not self.idle and self.started >= self.size:
+                self.available.wait()
+            engine = self.idle.pop() if self.idle else None
+            if engine is None:
+                self.started += 1
+        if engine is None:
+            try:
+                engine = UCIEngine(self.command, self.options)
+            except Exception:
+                self.discard(None)
+                raise
+
+        try:
+            yield engine
+        except EngineError:
+            self.discard(engine)
+            raise
+        except BaseException:
+            self.release(engine)
+            raise
+        else:
+            self.release(engine)
+
+    def release(self, engine: UCIEngine):
+        with self.available:
+            self.idle.append(engine)
+            self.available.notify()
+
+    def discard(self, engine: UCIEngine):
+        """Closes engine, None if it never started, and frees its slot"""
+        if engine is not None:
+            engine.close()
+        with self.available:
+            self.started -= 1
+            self.available.notify()
+
+    def evaluate(self, board: chess.Board) -> float:
+        """returns the engine's score of board in pawns from white's side"""
+        key = None
+        if self.cache is not None:
+            key = f"{self.command} depth {self.depth} nodes {self.nodes} {board.epd()}"
+            score = self.cache.lookup(key)
+            if score is not None:
+                return score
+
+        with self.engine() as engine:
+            score = engine.analyse(board, self.depth, self.nodes) / 100
+        if key is not None:
+            self.cache.store(key, score)
+        return score
+
+    def close(self):
+        """Quits every idle engine of this process"""
+        if self.pid != os.getpid():
+            return
+        with self.available:
+            engines, self.idle = self.idle, []
+        for engine in engines:
+            self.discard(engine)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Stand-in for Stockfish that speaks enough UCI for EnginePool: it scores a position
+by material alone, from the side to move, and plays its first legal move
+
+STOCKFISH_PATH=chess_standard/fake_uci_engine.py points BoardPypiChess at it
+"""
+
+import sys
+
+import chess
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 300,
+    chess.BISHOP: 300,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+
+
+def material(board: chess.Board) -> int:
+    score = 0
+    for piece in board.piece_map().values():
+        value = PIECE_VALUES[piece.piece_type]
+        score += value if piece.color == board.turn else -value
+    return score
+
+
+def position(args: list) -> chess.Board:
+    if args[0] == "startpos":
+        board = chess.Board()
+        args = args[1:]
+    else:
+        end = args.index("moves") if "moves" in args else len(args)
+        board = chess.Board(" ".join(args[1:end]))
+        args = args[end:]
+    for move in args[1:]:
+        board.push_uci(move)
+    return board
+
+
+def main():
+    board = chess.Board()
+    options = {"Threads": "1", "Hash": "16"}
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        command, *args = line.split()
+        if command == "uci":
+            print("id name FakeUCI")
+            print("option name Threads type spin default 1 min 1 max 1024")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("uciok")
+        elif command == "setoption":
+            options[args[1]] = args[3]
+        elif command == "isready":
+            print("readyok")
+        elif command == "position":
+            board = position(args)
+        elif command == "go":
+            if board.is_checkmate():
+                print("info depth 0 score mate 0")
+                print("bestmove (none)")
+            elif board.is_stalemate():
+                print("info depth 0 score cp 0")
+                print("bestmove (none)")
+            else:
+                depth = args[args.index("depth") + 1] if "depth" in args else "1"
+                print(f"info depth {depth} score cp {material(board)} nodes 1")
+                best = next(iter(board.legal_moves), None)
+                print(f"bestmove {best.uci() if best else '(none)'}")
+        elif command == "quit":
+            break
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
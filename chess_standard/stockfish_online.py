@@ -0,0 +1,126 @@
+import asyncio
+import atexit
+import os
+import threading
+from typing import List
+
+import aiohttp
+
+STOCKFISH_API = "https://stockfish.online/api/s/v2.php"
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class StockfishOnline:
+    def __init__(
+        self,
+        url: str = STOCKFISH_API,
+        depth: int = 10,
+        concurrency: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 10,
+    ):
+        """
+        Client of the stockfish.online evaluation endpoint, or of anything answering
+        GET url?fen=...&depth=... with its JSON ({"success", "evaluation", "mate"})
+
+        Requests run on an event loop in a background thread that keeps one session, so
+        connections stay alive from batch to batch. At most concurrency requests are in
+        flight, each attempt gets timeout seconds, and failed attempts (connection
+        errors, timeouts, 429 and 5xx) are retried up to retries times, waiting backoff
+        seconds doubled on every retry. The session is closed at exit.
+        """
+        self.url = url
+        self.depth = depth
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.semaphore = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        atexit.register(self.close)
+
+    def start(self):
+        """Starts the event loop thread, again in a forked child"""
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.session = None
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def fetch(self, fen: str):
+        """returns the endpoint's JSON for fen, None once every attempt has failed"""
+        params = {"fen": fen, "depth": str(self.depth)}
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            self.requests += 1
+            try:
+                async with self.semaphore:
+                    async with self.session.get(self.url, params=params) as response:
+                        if response.status == 200:
+                            data = await response.json(content_type=None)
+                            if data.get("success", True):
+                                return data
+                            break  # the endpoint rejected the position
+                        if response.status not in RETRY_STATUSES:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                pass
+        self.failures += 1
+        return None
+
+    async def fetch_all(self, fens: List[str]) -> list:
+        await self.open()
+        return await asyncio.gather(*[self.fetch(fen) for fen in fens])
+
+    def evaluate(self, fens: List[str]) -> list:
+        """
+        Scores every position at once, in pawns from white's side, a forced mate being
+        +-inf and a position the endpoint never answered None
+        """
+        self.start()
+        unique = list(dict.fromkeys(fens))
+        future = asyncio.run_coroutine_threadsafe(self.fetch_all(unique), self.loop)
+        scores = {}
+        for fen, data in zip(unique, future.result()):
+            if data is None:
+                scores[fen] = None
+            elif data.get("mate") is not None:
+                scores[fen] = float("inf") if data["mate"] > 0 else float("-inf")
+            else:
+                scores[fen] = float(data.get("evaluation") or 0)
+        return [scores[fen] for fen in fens]
+
+    def close(self):
+        if self.loop is None or self.pid != os.getpid():
+            return
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "failures": self.failures}
@@ -0,0 +1,58 @@
+"""
+Local stand-in for the stockfish.online endpoint, answering with the same JSON from a
+material count, so StockfishOnline can be exercised offline
+
+python -m chess_standard.stub_stockfish_server --port 8765 --fail-rate 0.2
+
+(from the repository root, so the chess_standard package can be imported)
+"""
+
+import argparse
+import asyncio
+import random
+
+import chess
+from aiohttp import web
+
+from chess_standard.fake_uci_engine import material
+
+
+def make_app(fail_rate: float = 0.0, delay: float = 0.0) -> web.Application:
+    """
+    fail_rate of the requests get a 503, and every answer waits delay seconds.
+    app["stats"]["requests"] counts the positions answered.
+    """
+
+    async def evaluate(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        if random.random() < fail_rate:
+            return web.Response(status=503)
+        try:
+            board = chess.Board(request.query["fen"])
+        except (KeyError, ValueError):
+            return web.json_response({"success": False, "data": "Invalid FEN"})
+
+        request.app["stats"]["requests"] += 1
+        if board.is_checkmate():
+            mate = -1 if board.turn == chess.WHITE else 1
+            return web.json_response(
+                {"success": True, "evaluation": None, "mate": mate}
+            )
+        score = material(board) if board.turn == chess.WHITE else -material(board)
+        return web.json_response(
+            {"success": True, "evaluation": score / 100, "mate": None}
+        )
+
+    app = web.Application()
+    app["stats"] = {"requests": 0}  # mutated in place, the app is frozen once started
+    app.router.add_get("/api/s/v2.php", evaluate)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.fail_rate, args.delay), port=args.port)
@@ -0,0 +1,134 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List
+
+import numpy as np
+from common.board import BlankBoard
+
+LATENCY_SAMPLES = 10000  # most recent evaluation times kept for the percentiles
+
+
+class Adjudicator:
+    def __init__(self, workers: int = 4, timeout: float = None, fallback: int = 0):
+        """
+        Evaluates the boards whose terminal_eval is slow (terminal_slow, such as an
+        engine call past the move limit) on a pool of at most workers threads, all the
+        slow boards of a batch at once
+
+        When the board class batch_terminal_evals, the slow boards are instead
+        evaluated by one terminal_evals call, such as one round trip to an online
+        engine, on a single worker.
+
+        Boards of a batch with the same zobrist_hash are evaluated once. A batch waits
+        at most timeout seconds for its slow boards; the ones still running get
+        fallback, 0 being a draw from either side, and finish in the background while
+        holding their worker. stats() gives the counts and latency percentiles.
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.fallback = fallback
+        self.executor = None
+        self.pid = None
+
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.evaluations = 0
+        self.duplicates = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None  # threads do not cross into another process
+        return state
+
+    def pool(self) -> ThreadPoolExecutor:
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.pid = os.getpid()
+        return self.executor
+
+    def player_perspective_evals(self, boards: List[BlankBoard]) -> list:
+        """player_perspective_eval of every board, 2 for None"""
+        return self.evaluate(boards, perspective=True)
+
+    def terminal_evals(self, boards: List[BlankBoard]) -> list:
+        """terminal_eval of every board, 2 for None"""
+        return self.evaluate(boards, perspective=False)
+
+    def evaluate(self, boards: List[BlankBoard], perspective: bool) -> list:
+        results = [2] * len(boards)
+        slow = {}  # zobrist key -> indices of the boards with it
+        for i, board in enumerate(boards):
+            if board is None:
+                continue
+            if board.terminal_slow():
+                slow.setdefault(board.zobrist_hash(), []).append(i)
+            elif perspective:
+                results[i] = board.player_perspective_eval()
+            else:
+                results[i] = board.terminal_eval()
+
+        if len(slow) == 0:
+            return results
+
+        groups = list(slow.values())
+        firsts = [boards[indices[0]] for indices in groups]
+        if type(firsts[0]).batch_terminal_evals():
+            futures = {self.pool().submit(self.timed, firsts, perspective): groups}
+        else:
+            futures = {
+                self.pool().submit(self.timed, [board], perspective): [indices]
+                for board, indices in zip(firsts, groups)
+            }
+        done, _ = wait(futures, timeout=self.timeout)
+        self.evaluations += len(groups)
+        self.duplicates += sum(len(indices) - 1 for indices in groups)
+        for future, future_groups in futures.items():
+            if future in done:
+                values = future.result()
+            else:
+                future.cancel()  # only stops it if it has not started
+                self.timeouts += len(future_groups)
+                values = [self.fallback] * len(future_groups)
+            for value, indices in zip(values, future_groups):
+                for i in indices:
+                    results[i] = value
+        return results
+
+    def timed(self, boards: List[BlankBoard], perspective: bool) -> list:
+        """Evaluates boards together, a batch of one unless they batch_terminal_evals"""
+        st = time.time()
+        try:
+            if len(boards) > 1:
+                values = type(boards[0]).terminal_evals(boards)
+            if perspective:
+                # a batch leaves each board its result, see BlankBoard.terminal_evals
+                values = [board.player_perspective_eval() for board in boards]
+            elif len(boards) == 1:
+                values = [boards[0].terminal_eval()]
+        except Exception as e:
+            self.errors += 1
+            values = [2] * len(boards)
+            print("Error from the following boards")
+            print(e)
+            for board in boards:
+                print(board.board)
+        self.latencies.append(time.time() - st)
+        return values
+
+    def stats(self) -> dict:
+        latencies = (
+            np.array(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+        )
+        return {
+            "evaluations": self.evaluations,
+            "duplicates": self.duplicates,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "latency_ms_mean": float(latencies.mean()),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p90": float(np.percentile(latencies, 90)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+        }
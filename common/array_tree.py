@@ -0,0 +1,320 @@
+import itertools
+
+import numpy as np
+from common.board import BlankBoard
+
+TREE_SERIALS = itertools.count()  # never reused, unlike id() of a freed tree
+
+
+class ArrayTree:
+    def __init__(self, capacity: int = 1024):
+        """
+        Struct-of-arrays storage for a whole search tree
+
+        Node i is described by row i of every array. The children of a node are stored
+        contiguously, starting at first_child[i] and spanning num_children[i] rows, and
+        move[j] holds the index of child j in the p-vector. Unexpanded nodes have
+        first_child == -1. Arrays double in size when they run out of rows.
+        """
+        self.size = 0
+        self.n = np.zeros(capacity, dtype=np.int64)
+        self.w = np.zeros(capacity, dtype=np.float64)
+        self.p = np.zeros(capacity, dtype=np.float64)
+        self.parent = np.full(capacity, -1, dtype=np.int64)
+        self.first_child = np.full(capacity, -1, dtype=np.int64)
+        self.num_children = np.zeros(capacity, dtype=np.int64)
+        self.move = np.full(capacity, -1, dtype=np.int16)
+        self.boards = [None] * capacity
+        self.num_actions = 0
+        self.serial = next(TREE_SERIALS)
+
+        self.allocate(1)  # the root is always row 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.n)
+
+    def grow(self, min_capacity: int):
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        extra = capacity - self.capacity
+
+        self.n = np.concatenate([self.n, np.zeros(extra, dtype=np.int64)])
+        self.w = np.concatenate([self.w, np.zeros(extra, dtype=np.float64)])
+        self.p = np.concatenate([self.p, np.zeros(extra, dtype=np.float64)])
+        self.parent = np.concatenate([self.parent, np.full(extra, -1, dtype=np.int64)])
+        self.first_child = np.concatenate(
+            [self.first_child, np.full(extra, -1, dtype=np.int64)]
+        )
+        self.num_children = np.concatenate(
+            [self.num_children, np.zeros(extra, dtype=np.int64)]
+        )
+        self.move = np.concatenate([self.move, np.full(extra, -1, dtype=np.int16)])
+        self.boards.extend([None] * extra)
+
+    def allocate(self, count: int) -> int:
+        """Reserves count consecutive rows and returns the first one"""
+        start = self.size
+        if start + count > self.capacity:
+            self.grow(start + count)
+        self.size += count
+        return start
+
+    def expand(self, index: int, moves: np.ndarray, priors: np.ndarray):
+        start = self.allocate(len(moves))
+        end = start + len(moves)
+        self.parent[start:end] = index
+        self.move[start:end] = moves
+        self.p[start:end] = priors
+        self.first_child[index] = start
+        self.num_children[index] = len(moves)
+
+    def back_propagate(self, index: int, eval):
+        while index != -1:
+            self.n[index] += 1
+            self.w[index] += eval
+            eval = -1 * eval
+            index = self.parent[index]
+
+    def subtree_rows(self, index: int) -> int:
+        """Rows the subtree under index holds, counting each shared child block once"""
+        rows = 1
+        blocks = set()
+        stack = [index]
+        while stack:
+            node = stack.pop()
+            first = self.first_child[node]
+            if first == -1 or first in blocks:
+                continue
+            blocks.add(first)
+            count = self.num_children[node]
+            rows += count
+            stack.extend(range(first, first + count))
+        return rows
+
+    def extract(self, index: int) -> "ArrayTree":
+        """
+        Copies the subtree under index into a new, packed tree whose root is row 0,
+        leaving behind every row outside it. Child blocks shared through a
+        transposition table stay shared in the copy.
+
+        The copy is sized to the subtree, so it holds no more rows than it uses.
+        """
+        tree = ArrayTree(capacity=self.subtree_rows(index))
+        tree.num_actions = self.num_actions
+        tree.n[0] = self.n[index]
+        tree.w[0] = self.w[index]
+        tree.p[0] = np.nan
+        tree.boards[0] = self.boards[index]
+
+        blocks = {}  # old first_child -> new first_child
+        stack = [(index, 0)]
+        while stack:
+            old, new = stack.pop()
+            first = self.first_child[old]
+            if first == -1:
+                continue
+            count = self.num_children[old]
+            if first in blocks:
+                tree.first_child[new] = blocks[first]
+                tree.num_children[new] = count
+                continue
+
+            start = tree.allocate(count)
+            blocks[first] = start
+            old_rows = slice(first, first + count)
+            new_rows = slice(start, start + count)
+            tree.n[new_rows] = self.n[old_rows]
+            tree.w[new_rows] = self.w[old_rows]
+            tree.p[new_rows] = self.p[old_rows]
+            tree.move[new_rows] = self.move[old_rows]
+            tree.parent[new_rows] = new
+            tree.boards[new_rows] = self.boards[old_rows]
+            tree.first_child[new] = start
+            tree.num_children[new] = count
+            stack.extend((first + i, start + i) for i in range(count))
+
+        return tree
+
+    def nbytes(self) -> int:
+        """Memory of the rows in use, the spare capacity of the arrays excluded"""
+        arrays = [
+            self.n,
+            self.w,
+            self.p,
+            self.parent,
+            self.first_child,
+            self.num_children,
+            self.move,
+        ]
+        return sum(array[: self.size].nbytes for array in arrays)
+
+
+class ArrayNode:
+    """
+    Handle to a row of an ArrayTree with the same interface as common.mcts.Node,
+    so select, get_board, mcts and Parallel_MCTS can search on either one
+
+    ArrayNode() starts a new tree and returns a handle to its root
+    """
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: ArrayTree = None, index: int = 0):
+        self.tree = ArrayTree() if tree is None else tree
+        self.index = index
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ArrayNode)
+            and self.tree is other.tree
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def cache_key(self) -> tuple:
+        """Names this row without holding a reference to its tree, see BoardCache"""
+        return self.tree.serial, self.index
+
+    @property
+    def parent(self) -> "ArrayNode":
+        parent = self.tree.parent[self.index]
+        if parent == -1:
+            return None
+        return ArrayNode(self.tree, parent)
+
+    @parent.setter
+    def parent(self, value):
+        assert value is None, "an ArrayNode can only be detached from its parent"
+        self.tree.parent[self.index] = -1
+
+    @property
+    def children(self) -> list:
+        """One handle per legal move, in the order of child_stats()"""
+        first = self.tree.first_child[self.index]
+        if first == -1:
+            return None
+        last = first + self.tree.num_children[self.index]
+        return [ArrayNode(self.tree, i) for i in range(first, last)]
+
+    @property
+    def num_actions(self) -> int:
+        return self.tree.num_actions
+
+    @property
+    def board(self) -> BlankBoard:
+        return self.tree.boards[self.index]
+
+    @board.setter
+    def board(self, value: BlankBoard):
+        self.tree.boards[self.index] = value
+
+    @property
+    def child_index(self) -> int:
+        move = self.tree.move[self.index]
+        return None if move == -1 else int(move)
+
+    @child_index.setter
+    def child_index(self, value: int):
+        self.tree.move[self.index] = -1 if value is None else value
+
+    @property
+    def n(self) -> int:
+        return self.tree.n[self.index]
+
+    @n.setter
+    def n(self, value: int):
+        self.tree.n[self.index] = value
+
+    @property
+    def w(self) -> np.float64:
+        return self.tree.w[self.index]
+
+    @w.setter
+    def w(self, value: np.float64):
+        self.tree.w[self.index] = value
+
+    @property
+    def p(self) -> np.float64:
+        return self.tree.p[self.index]
+
+    @p.setter
+    def p(self, value: np.float64):
+        self.tree.p[self.index] = np.nan if value is None else value
+
+    def make_children(self, ps: np.ndarray, board: BlankBoard = None):
+        board = self.board if board is None else board
+        self.tree.num_actions = len(ps)
+        moves = np.flatnonzero(board.legal_moves())
+        self.tree.expand(self.index, moves, ps[moves])
+
+    def is_leaf(self) -> bool:
+        return self.tree.num_children[self.index] == 0
+
+    def child(self, i: int) -> "ArrayNode":
+        return ArrayNode(self.tree, self.tree.first_child[self.index] + i)
+
+    def child_stats(self):
+        """returns the legal moves and their priors, visit counts and total values"""
+        tree = self.tree
+        first = tree.first_child[self.index]
+        last = first + tree.num_children[self.index]
+        return (
+            tree.move[first:last],
+            tree.p[first:last],
+            tree.n[first:last],
+            tree.w[first:last],
+        )
+
+    def value_score(self):
+        n = self.tree.n[self.index]
+        if n > 0:
+            return self.tree.w[self.index] / n
+        else:
+            return 0
+
+    def record(self, n: int, w):
+        self.tree.n[self.index] += n
+        self.tree.w[self.index] += w
+
+    def share_children(self, other: "ArrayNode") -> bool:
+        """Points this unexpanded node at the children of other, if both live in one tree"""
+        if other.tree is not self.tree:
+            return False
+        self.tree.first_child[self.index] = self.tree.first_child[other.index]
+        self.tree.num_children[self.index] = self.tree.num_children[other.index]
+        return True
+
+    def collapse(self):
+        """Forgets this node's expansion; the child rows stay until the tree is extracted"""
+        self.tree.first_child[self.index] = -1
+        self.tree.num_children[self.index] = 0
+
+    def release(self):
+        """Drops the boards of the whole tree; its arrays are freed with the last handle"""
+        self.tree.boards = [None] * self.tree.capacity
+
+    def promote(self, release: bool = True) -> "ArrayNode":
+        """
+        Makes this node the root of its own tree. With release set its subtree is copied
+        out, so the rows of its siblings are freed with the old tree; otherwise it is
+        only detached, keeping rows a transposition table may still point at.
+
+        returns the new root
+        """
+        if release:
+            return ArrayNode(self.tree.extract(self.index), 0)
+
+        self.parent = None
+        self.child_index = None
+        self.p = None
+        return self
+
+    def nbytes(self) -> int:
+        return self.tree.nbytes()
+
+    def back_propagate(self, eval):
+        self.tree.back_propagate(self.index, eval)
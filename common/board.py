@@ -31,6 +31,22 @@ class BlankBoard:
         """
         pass
 
+    @classmethod
+    def batch_terminal_evals(cls) -> bool:
+        """
+        Returns whether the slow terminal_evals of many boards are cheaper computed
+        together, by terminal_evals, than one at a time
+        """
+        return False
+
+    @classmethod
+    def terminal_evals(cls, boards: List["BlankBoard"]) -> list:
+        """
+        Returns terminal_eval of every board. Boards that batch them should keep each
+        result, as player_perspective_eval may be asked for afterwards.
+        """
+        return [board.terminal_eval() for board in boards]
+
     @abc.abstractmethod
     def move_from_int(self, num: int) -> "BlankBoard":
         """
@@ -46,6 +62,40 @@ class BlankBoard:
         """
         pass
 
+    def encode_into(self, out: torch.Tensor):
+        """
+        Writes the to_tensor() encoding into out, a preallocated CPU tensor of the same
+        shape, such as a row of an input batch. Boards override this to skip the
+        intermediate tensors.
+        """
+        out.copy_(self.to_tensor())
+
+    @classmethod
+    def adjudication_stats(cls) -> dict:
+        """
+        Returns the hit counts of the board's adjudication cache (entries, hits, misses,
+        hit_rate) and the positions each adjudication tier settled (tiers,
+        engine_avoided), or None for boards whose terminal_eval needs neither
+        """
+        return None
+
+    @classmethod
+    def use_save_dir(cls, save_dir: str):
+        """
+        Called with the save directory of a training run, for boards that keep files
+        (such as an adjudication cache) there. Does nothing by default.
+        """
+        pass
+
+    @abc.abstractmethod
+    def zobrist_hash(self) -> int:
+        """
+        Returns a 64 bit key of the position, equal for boards reached through different
+        move orders. Keys must never repeat along a line of play, so search graphs built
+        from them stay acyclic.
+        """
+        pass
+
     @abc.abstractmethod
     def player_perspective_eval(self) -> int:
         """
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from common.board import BlankBoard
+
+
+class BoardCache:
+    def __init__(self, max_boards: int = 10000):
+        """
+        Least recently used store of materialized boards for search nodes that do not
+        keep their own, holding at most max_boards
+
+        Used by get_board, which rebuilds evicted boards by replaying moves from the
+        nearest ancestor whose board is still at hand. Entries are keyed by
+        node.cache_key(), so an ArrayNode entry does not keep its whole tree alive
+        after the tree is extracted or released.
+        """
+        self.max_boards = max_boards
+        self.boards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.replayed = 0  # moves replayed to rebuild missing boards
+
+    def __len__(self):
+        return len(self.boards)
+
+    def lookup(self, node) -> BlankBoard:
+        board = self.peek(node)
+        if board is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return board
+
+    def peek(self, node) -> BlankBoard:
+        """Like lookup, without touching the hit/miss counters"""
+        key = node.cache_key()
+        board = self.boards.get(key)
+        if board is not None:
+            self.boards.move_to_end(key)
+        return board
+
+    def store(self, node, board: BlankBoard):
+        key = node.cache_key()
+        self.boards[key] = board
+        self.boards.move_to_end(key)
+        if len(self.boards) > self.max_boards:
+            self.boards.popitem(last=False)
+
+    def clear(self):
+        self.boards.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "boards": len(self.boards),
+            "hits": self.hits,
+            "misses": self.misses,
+            "replayed": self.replayed,
+            "hit_rate": self.hit_rate(),
+        }
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import itertools
+import numpy as np
+import torch
+
+ENTRY_OVERHEAD = 200  # rough bytes per entry besides the p-vector: dict slot, key, tuple, array header
+
+
+def weights_fingerprint(nnet: torch.nn.Module):
+    """
+    Changes whenever the network's outputs might: another network or weights
+    generation, a train/eval switch, or any in-place update of its weights (optimizer
+    steps, load_state_dict), which bumps the tensors' version counters
+
+    generation is an attribute the owner sets on each new set of weights. It is what
+    tells them apart when the weights are not visible here, as with an InferenceClient,
+    or when a new network reuses a freed one's id.
+    """
+    tensors = itertools.chain(nnet.parameters(), nnet.buffers())
+    generation = getattr(nnet, "generation", None)
+    return id(nnet), generation, nnet.training, tuple(t._version for t in tensors)
+
+
+class EvalCache:
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        """
+        Least recently used cache of network outputs, (p_vec, eval), keyed by
+        BlankBoard.zobrist_hash() and holding at most max_bytes
+
+        Every batch should call sync(nnet) first, which empties the cache when the
+        network or its weights have changed since the entries were stored
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sync(self, nnet: torch.nn.Module):
+        fingerprint = weights_fingerprint(nnet)
+        if fingerprint != self.fingerprint:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.clear()
+            self.fingerprint = fingerprint
+
+    def lookup(self, key: int):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key: int, p_vec: np.ndarray, eval: np.float64):
+        if key in self.entries:
+            return
+
+        p_vec = np.array(p_vec)  # a copy, so the cache never pins a whole batch array
+        self.entries[key] = (p_vec, np.float64(eval))
+        self.nbytes += p_vec.nbytes + ENTRY_OVERHEAD
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, (old_p_vec, _) = self.entries.popitem(last=False)
+            self.nbytes -= old_p_vec.nbytes + ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hit_rate(),
+        }
@@ -0,0 +1,253 @@
+import queue
+import signal
+import time
+from collections import Counter, deque
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+LATENCY_SAMPLES = 100000  # most recent queue latencies kept for the percentiles
+RESPONSE_TIMEOUT = 1  # seconds between checks that the server is still running
+
+
+class InferenceClient:
+    def __init__(
+        self,
+        client,
+        requests,
+        inputs,
+        policies,
+        values,
+        response,
+        alive,
+        generation=None,
+    ):
+        """
+        Stand-in for the network inside a worker process: calling it with a batch of
+        board tensors returns (p_vecs, evals) like the network would, computed by the
+        InferenceServer that owns the real one
+
+        Batches larger than the client's shared buffer are sent in pieces. generation
+        is that of the server's weights, see weights_fingerprint. alive is the read end
+        of a pipe only the server writes to, which closes when the server exits, so a
+        client never waits on a dead server
+        """
+        self.client = client
+        self.requests = requests
+        self.inputs = inputs
+        self.policies = policies
+        self.values = values
+        self.response = response
+        self.alive = alive
+        self.generation = generation
+        self.training = False
+
+    def __call__(self, tensors: torch.Tensor):
+        capacity = len(self.inputs)
+        p_vecs = []
+        evals = []
+        for chunk in torch.split(tensors, capacity):
+            count = len(chunk)
+            self.inputs[:count].copy_(chunk)
+            self.requests.put((self.client, count, time.time()))
+            self.wait()
+            p_vecs.append(self.policies[:count].clone())
+            evals.append(self.values[:count].clone())
+        return torch.cat(p_vecs), torch.cat(evals)[:, None]
+
+    def wait(self):
+        while True:
+            try:
+                return self.response.get(timeout=RESPONSE_TIMEOUT)
+            except queue.Empty:
+                if self.alive.poll():  # end of file: the server is gone
+                    raise RuntimeError("inference server exited")
+
+    def parameters(self):
+        """
+        The weights live in the server, so none are visible here: generation is what
+        changes with them
+        """
+        return iter(())
+
+    def buffers(self):
+        return iter(())
+
+
+class InferenceServer:
+    def __init__(
+        self,
+        net: torch.nn.Module,
+        sample: torch.Tensor,
+        clients: int,
+        client_batch: int,
+        max_batch: int = 1024,
+        max_wait: float = 0.002,
+    ):
+        """
+        One process that owns net and evaluates the positions of every client together
+
+        Each client gets shared memory buffers for up to client_batch positions, shaped
+        after sample, a single board tensor. The server gathers requests until it holds
+        max_batch positions or max_wait seconds have passed since the first one was
+        submitted, then runs them through one forward pass.
+
+        The server's weights never change while it runs. generation identifies them,
+        taken from net.generation when set, and every client carries it.
+
+        Use client(i) inside the i-th worker in place of the network, and stop() to get
+        the batch size histogram and queue latencies.
+        """
+        with torch.no_grad():
+            p_vec, _ = net(sample[None].to(device))
+        outputs = p_vec.shape[1]
+
+        self.net = net
+        self.generation = getattr(net, "generation", None)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = mp.Queue()
+        self.stats_queue = mp.Queue()
+        self.inputs = [
+            torch.zeros((client_batch, *sample.shape)).share_memory_()
+            for _ in range(clients)
+        ]
+        self.policies = [
+            torch.zeros((client_batch, outputs)).share_memory_() for _ in range(clients)
+        ]
+        self.values = [
+            torch.zeros(client_batch).share_memory_() for _ in range(clients)
+        ]
+        self.responses = [mp.Queue() for _ in range(clients)]
+        self.alive, self.alive_end = mp.Pipe(duplex=False)
+        self.process = None
+
+    def client(self, i: int) -> InferenceClient:
+        return InferenceClient(
+            i,
+            self.requests,
+            self.inputs[i],
+            self.policies[i],
+            self.values[i],
+            self.responses[i],
+            self.alive,
+            self.generation,
+        )
+
+    def start(self):
+        self.process = mp.Process(
+            target=serve,
+            args=(
+                self.net,
+                self.requests,
+                self.inputs,
+                self.policies,
+                self.values,
+                self.responses,
+                self.stats_queue,
+                self.max_batch,
+                self.max_wait,
+                self.alive_end,
+            ),
+        )
+        self.process.start()
+        self.alive_end.close()  # the server now holds the only write end
+
+    def stop(self) -> dict:
+        """
+        Shuts the server down after answering every queued request, returns its stats,
+        None if it had already died
+        """
+        self.requests.put(None)
+        while True:
+            try:
+                stats = self.stats_queue.get(timeout=RESPONSE_TIMEOUT)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    stats = None
+                    break
+        self.process.join()
+        return stats
+
+
+def serve(
+    net,
+    requests,
+    inputs,
+    policies,
+    values,
+    responses,
+    stats_queue,
+    max_batch,
+    max_wait,
+    alive_end,
+):
+    # Ctrl-C is for the parent, which stops the server once its clients are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    net.eval()
+    batch_sizes = Counter()  # power of two bucket -> batches
+    latencies = deque(maxlen=LATENCY_SAMPLES)
+    positions = 0
+
+    carry = None
+    running = True
+    while running:
+        pending = [requests.get() if carry is None else carry]
+        carry = None
+        if pending[0] is None:
+            break
+
+        total = pending[0][1]
+        start = pending[0][2]  # the wait counts from submission, not from dequeue
+        while total < max_batch:
+            timeout = max_wait - (time.time() - start)
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:  # answer what was gathered, then stop
+                running = False
+                break
+            if total + request[1] > max_batch:
+                carry = request
+                break
+            pending.append(request)
+            total += request[1]
+
+        st = time.time()
+        batch = torch.cat([inputs[client][:count] for client, count, _ in pending])
+        with torch.no_grad():
+            p_vecs, evals = net(batch.to(device))
+        p_vecs = p_vecs.detach().cpu()
+        evals = evals.detach().cpu()[:, 0]
+
+        offset = 0
+        for client, count, submitted in pending:
+            policies[client][:count] = p_vecs[offset : offset + count]
+            values[client][:count] = evals[offset : offset + count]
+            offset += count
+            latencies.append(st - submitted)
+            responses[client].put(True)
+
+        batch_sizes[1 << (total - 1).bit_length()] += 1
+        positions += total
+
+    latencies = np.array(latencies) * 1000 if len(latencies) > 0 else np.zeros(1)
+    batches = sum(batch_sizes.values())
+    stats_queue.put(
+        {
+            "batches": batches,
+            "positions": positions,
+            "mean_batch": positions / batches if batches > 0 else 0.0,
+            "batch_histogram": dict(sorted(batch_sizes.items())),
+            "queue_ms_mean": float(latencies.mean()),
+            "queue_ms_p50": float(np.percentile(latencies, 50)),
+            "queue_ms_p99": float(np.percentile(latencies, 99)),
+        }
+    )
@@ -0,0 +1,34 @@
+import torch
+from typing import List
+from common.board import BlankBoard
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class InputBuffer:
+    def __init__(self, max_batch: int = 0):
+        """
+        Reusable network input of up to max_batch boards, filled in place with
+        BlankBoard.encode_into. Grows when a larger batch comes in. Pinned when CUDA is
+        present, so the copy to the device can run asynchronously.
+        """
+        self.max_batch = max_batch
+        self.buffer = None
+
+    def allocate(self, batch: int, board: BlankBoard):
+        if self.buffer is not None:
+            self.max_batch *= 2
+        self.max_batch = max(self.max_batch, batch)
+        self.buffer = torch.empty(
+            (self.max_batch, *board.to_tensor().shape),
+            pin_memory=torch.cuda.is_available(),
+        )
+
+    def encode(self, boards: List[BlankBoard]) -> torch.Tensor:
+        """returns the encoded boards on the device, valid until the next encode"""
+        if self.buffer is None or len(boards) > len(self.buffer):
+            self.allocate(len(boards), boards[0])
+
+        for row, board in zip(self.buffer, boards):
+            board.encode_into(row)
+        return self.buffer[: len(boards)].to(device, non_blocking=True)
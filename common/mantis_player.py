@@ -0,0 +1,132 @@
+import atexit
+import threading
+import time
+import numpy as np
+import torch
+from common.board import BlankBoard
+from common.mcts import get_board, mcts
+from common.player import BlankPlayer
+
+
+class MantisPlayer(BlankPlayer):
+    def __init__(
+        self,
+        net: torch.nn.Module,
+        runs: int = 500,
+        leaf_batch: int = 1,
+        seconds: float = None,
+        ponder: bool = False,
+        ponder_runs: int = 100000,
+    ):
+        """
+        Plays the move chosen by mcts with net
+
+        Searches runs simulations per move by default, or for seconds of wall-clock
+        time if given. The stats of the last search are kept in last_stats.
+
+        With ponder set, the tree below the move played keeps growing in a background
+        thread (up to ponder_runs simulations) while the opponent thinks, and the
+        subtree of the move they answer with becomes the root of the next search
+        """
+        self.net = net
+        self.runs = runs
+        self.leaf_batch = leaf_batch
+        self.seconds = seconds
+        self.last_stats = {}
+
+        self.ponder = ponder
+        self.ponder_runs = ponder_runs
+        self.ponder_head = None
+        self.ponder_thread = None
+        self.ponder_stop = threading.Event()
+        if ponder:
+            # torch aborts the interpreter if a search thread outlives it
+            atexit.register(self.stop_pondering)
+
+    def search(self, board: BlankBoard, seconds: float = None, nodes: int = None):
+        """
+        Anytime search: stops once seconds have passed or nodes simulations are done,
+        whichever comes first, and plays the best move found by then. With neither
+        given, the player's own seconds or runs are used.
+
+        returns next board, index of move, stats (sims, seconds, nodes_per_sec, ...)
+        """
+        if seconds is None and nodes is None:
+            seconds = self.seconds
+            nodes = self.runs if seconds is None else None
+
+        head_node = self.stop_pondering(board)
+        deadline = None if seconds is None else time.time() + seconds
+        stats = {"reused_sims": 0 if head_node is None else int(head_node.n)}
+        with torch.no_grad():
+            board, _, index, best = mcts(
+                board,
+                self.net,
+                runs=nodes,
+                head_node=head_node,
+                leaf_batch=self.leaf_batch,
+                deadline=deadline,
+                stats=stats,
+            )
+        self.last_stats = stats
+
+        if self.ponder:
+            self.start_pondering(board, best)
+        return board, index, stats
+
+    def move(self, board: BlankBoard) -> BlankBoard:
+        board, _, _ = self.search(board)
+        return board
+
+    def move_and_get_index(self, board: BlankBoard) -> int:
+        _, index, _ = self.search(board)
+        return index
+
+    def start_pondering(self, board: BlankBoard, head):
+        """Keeps searching from head, the node of board, until stop_pondering"""
+        if board.terminal_slow() or board.terminal_eval() != 2:
+            return
+
+        self.ponder_head = head
+        self.ponder_stop.clear()
+        self.ponder_thread = threading.Thread(
+            target=self.ponder_loop, args=(board, head), daemon=True
+        )
+        self.ponder_thread.start()
+
+    def ponder_loop(self, board: BlankBoard, head):
+        with torch.no_grad():
+            _, _, _, best = mcts(
+                board,
+                self.net,
+                runs=self.ponder_runs,
+                head_node=head,
+                leaf_batch=self.leaf_batch,
+                stop=self.ponder_stop,
+            )
+        self.ponder_head = best.parent  # the root may have been moved into a new tree
+
+    def stop_pondering(self, board: BlankBoard = None):
+        """
+        Stops the background search, if any
+
+        returns the pondered node of board, if it is one reply away from the pondered
+        position and was visited, else None
+        """
+        if self.ponder_thread is None:
+            return None
+
+        self.ponder_stop.set()
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        head, self.ponder_head = self.ponder_head, None
+        if board is None or head.is_leaf():
+            return None
+
+        key = board.zobrist_hash()
+        _, _, n, _ = head.child_stats()
+        for i in np.flatnonzero(n > 0):
+            child = head.child(i)
+            if get_board(child).zobrist_hash() == key:
+                return child
+        return None
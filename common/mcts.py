@@ -1,33 +1,76 @@
 import numpy as np
 from common.board import BlankBoard
+from common.board_cache import BoardCache
+from common.eval_cache import EvalCache
+from common.transposition import TranspositionTable
+from common.tree_gc import enforce_node_budget, expanded_nodes
 import torch
 from typing import List
 from tqdm import tqdm
 
+import threading
 import time
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+VIRTUAL_LOSS = 1  # visits, each counted as a loss for the player choosing the node
+
+NODE_BYTES = 500  # rough size of a Node object with its attribute dict
+
 
 class Node:
     def __init__(
-        self, parent: "Node" = None, p: np.float64 = None, child_index: int = None
+        self,
+        parent: "Node" = None,
+        p: np.float64 = None,
+        child_index: int = None,
+        slot: int = None,
     ):
         self.parent = parent
         self.children = None
         self.board = None
         self.child_index = child_index
+        self.slot = slot  # position among the parent's legal moves
         self.n = 0
         self.w = 0
         self.p = p
 
-    def make_children(self, ps: np.ndarray):
-        self.children = np.empty(ps.shape, dtype=Node)
-        legals = self.board.legal_moves()
-        for i, pc in enumerate(ps):
-            if legals[i] == True:
-                self.children[i] = Node(self, pc, i)
+        # one entry per legal move, kept contiguous so select can score them at once;
+        # children[i] stays None until select first walks into move child_moves[i]
+        self.num_actions = None
+        self.child_moves = None
+        self.child_p = None
+        self.child_n = None
+        self.child_w = None
+
+    def make_children(self, ps: np.ndarray, board: BlankBoard = None):
+        """board is this node's position, needed when it isn't kept on the node"""
+        board = self.board if board is None else board
+        self.num_actions = len(ps)
+        self.child_moves = np.flatnonzero(board.legal_moves()).astype(np.int16)
+        self.child_p = ps[self.child_moves]
+        self.child_n = np.zeros(len(self.child_moves), dtype=np.int64)
+        self.child_w = np.zeros(len(self.child_moves), dtype=np.float64)
+        self.children = np.empty(len(self.child_moves), dtype=Node)
+
+    def is_leaf(self) -> bool:
+        return self.children is None or len(self.children) == 0
+
+    def cache_key(self) -> "Node":
+        return self
+
+    def child(self, i: int) -> "Node":
+        if self.children[i] is None:
+            node = Node(self, self.child_p[i], self.child_moves[i], i)
+            node.n = self.child_n[i]
+            node.w = self.child_w[i]
+            self.children[i] = node
+        return self.children[i]
+
+    def child_stats(self):
+        """returns the legal moves and their priors, visit counts and total values"""
+        return self.child_moves, self.child_p, self.child_n, self.child_w
 
     def value_score(self):
         if self.n > 0:
@@ -35,21 +78,262 @@ class Node:
         else:
             return 0
 
+    def record(self, n: int, w):
+        """Adds n visits worth w in total, mirroring them into the parent's child arrays"""
+        self.n += n
+        self.w += w
+        if self.parent is not None:
+            self.parent.child_n[self.slot] += n
+            self.parent.child_w[self.slot] += w
+
+    def share_children(self, other: "Node") -> bool:
+        """
+        Points this unexpanded node at the children of other, an expanded node of the
+        same position, so both share one subtree and one set of child statistics
+
+        returns whether the children could be shared
+        """
+        self.num_actions = other.num_actions
+        self.child_moves = other.child_moves
+        self.children = other.children
+        self.child_p = other.child_p
+        self.child_n = other.child_n
+        self.child_w = other.child_w
+        return True
+
+    def collapse(self):
+        """Forgets this node's expansion; its own statistics stay with its parent"""
+        self.num_actions = None
+        self.child_moves = None
+        self.children = None
+        self.child_p = None
+        self.child_n = None
+        self.child_w = None
+
+    def release(self):
+        """
+        Breaks every reference inside this subtree, so it is freed right away instead of
+        waiting for the cycle collector. Not safe while the subtree may share children
+        with live nodes through a transposition table.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.children is not None:
+                stack.extend(child for child in node.children if child is not None)
+            node.collapse()
+            node.parent = None
+            node.board = None
+
+    def promote(self, release: bool = True) -> "Node":
+        """
+        Makes this node the root of its own tree, releasing its siblings' subtrees if
+        release is set
+
+        Without release the node may also belong to other trees through a transposition
+        table, so it is left as it is: a new root sharing its children takes its place,
+        and they keep mirroring their statistics into the shared child arrays.
+
+        returns the new root
+        """
+        if not release:
+            return self.reroot()
+
+        parent = self.parent
+        if parent is not None:
+            for sibling in parent.children:
+                if sibling is not None and sibling is not self:
+                    sibling.release()
+            parent.children = None
+
+        self.parent = None
+        self.child_index = None
+        self.slot = None
+        self.p = None
+        return self
+
+    def reroot(self) -> "Node":
+        """
+        returns a parentless copy of this node sharing its children, which are moved
+        over to it so get_board can walk up from them to a root's board
+        """
+        root = Node()
+        root.n = self.n
+        root.w = self.w
+        root.board = self.board
+        if self.children is not None:
+            root.share_children(self)
+            for child in self.children:
+                if child is not None:
+                    child.parent = root
+        return root
+
+    def nbytes(self) -> int:
+        """Rough memory held by this node's child arrays and created children, boards excluded"""
+        if self.children is None:
+            return 0
+        arrays = [self.child_moves, self.child_p, self.child_n, self.child_w]
+        created = sum(child is not None for child in self.children)
+        return (
+            sum(array.nbytes for array in arrays)
+            + self.children.nbytes
+            + created * NODE_BYTES
+        )
+
     def back_propagate(self, eval):
-        self.n += 1
-        self.w += eval
+        node = self
+        while node is not None:
+            node.record(1, eval)
+            eval = -1 * eval
+            node = node.parent
+
+
+def puct(p: np.ndarray, n: np.ndarray, w: np.ndarray, parent_n: int) -> np.ndarray:
+    """
+    Scores a whole set of siblings from their priors, visit counts and total values
+
+    this is classic ucb, I think alphazero implements a slightly altered version
+    """
+    # cbase = 19562
+    # cinit = 1.25
+    q = np.divide(w, n, out=np.zeros(w.shape), where=n > 0)
+    return p * np.sqrt(parent_n) / (n + 1) - q
+
+
+def move_values(head: Node):
+    """
+    Softmax of the negated child values, spread over the whole p-vector with 0 for
+    illegal moves
+
+    returns the values and the slot of the best child
+    """
+    moves, _, n, w = head.child_stats()
+    q = np.divide(w, n, out=np.zeros(w.shape), where=n > 0)
+    values = np.full(head.num_actions, -np.inf)
+    values[moves] = -q
+    es = np.exp(values)
+    values = es / sum(es)
+
+    return values, int(np.argmax(values[moves]))
+
+
+def get_output(
+    board: BlankBoard, nnet: torch.nn.Module, eval_cache: EvalCache = None
+):  # Optional 7x1, float
+    p_vecs, evals = get_outputs([board], nnet, eval_cache)
+    return p_vecs[0], evals[0]
+
+
+def get_outputs(
+    boards: List[BlankBoard], nnet: torch.nn.Module, eval_cache: EvalCache = None
+):
+    """
+    Evaluates every unterminated board in a single forward pass, only sending the
+    boards missing from eval_cache (if given) through the network
 
-        if not (self.parent is None):
-            self.parent.back_propagate(-1 * eval)
+    returns List[p_vec or None if terminal], List[eval]
+    """
+    p_vecs = [None] * len(boards)
+    evals = [None] * len(boards)
+    keys = [None] * len(boards)
+    live = []
+    if eval_cache is not None:
+        eval_cache.sync(nnet)
+    for i, board in enumerate(boards):
+        if board.terminal_eval() != 2:
+            evals[i] = board.player_perspective_eval()
+            continue
+
+        if eval_cache is not None:
+            keys[i] = board.zobrist_hash()
+            cached = eval_cache.lookup(keys[i])
+            if cached is not None:
+                p_vecs[i], evals[i] = cached
+                continue
+        live.append(i)
+
+    if len(live) > 0:
+        tensors = torch.stack([boards[i].to_tensor() for i in live], dim=0)
+        live_p_vecs, live_evals = nnet(tensors.to(device))
+        live_p_vecs = live_p_vecs.detach().cpu().numpy()
+        live_evals = live_evals.detach().cpu().numpy()[:, 0]
+        for j, i in enumerate(live):
+            p_vecs[i] = live_p_vecs[j]
+            evals[i] = np.float64(live_evals[j])
+            if eval_cache is not None:
+                eval_cache.store(keys[i], p_vecs[i], evals[i])
+
+    return p_vecs, evals
+
+
+def transpose(node: Node, board: BlankBoard, transpositions: TranspositionTable):
+    """
+    Shares the subtree of an already expanded node of the same position with node
 
+    returns the shared node's eval (None on a miss) and the position key
+    """
+    key = board.zobrist_hash()
+    twin = transpositions.lookup(key)
+    if twin is not None and not twin.is_leaf() and node.share_children(twin):
+        return twin.value_score(), key
+    return None, key
 
-def get_output(board: BlankBoard, nnet: torch.nn.Module):  # Optional 7x1, float
-    if board.terminal_eval() == 2:
-        p_vec, eval = nnet(board.to_tensor().unsqueeze(0).to(device))
-        p_vec = p_vec.detach().cpu().numpy()[0, :]
-        eval = eval.detach().cpu().numpy()[0]
-        return p_vec, np.float64(eval)
-    return None, board.player_perspective_eval()
+
+def expand_leaves(
+    nodes: List[Node],
+    boards: List[BlankBoard],
+    nnet: torch.nn.Module,
+    transpositions: TranspositionTable = None,
+    eval_cache: EvalCache = None,
+):
+    """
+    Expands every leaf from one batched forward pass. With a transposition table, a
+    leaf whose position is already expanded elsewhere shares that subtree instead
+    and skips the network.
+
+    returns the eval of each leaf, from the perspective of its player to move, and the
+    number of leaves given children of their own (terminal and shared ones are not)
+    """
+    evals = [None] * len(nodes)
+    keys = [None] * len(nodes)
+    pending = []
+    for i, (node, board) in enumerate(zip(nodes, boards)):
+        if transpositions is not None:
+            evals[i], keys[i] = transpose(node, board, transpositions)
+            if evals[i] is not None:
+                continue
+        pending.append(i)
+
+    p_vecs, pending_evals = get_outputs([boards[i] for i in pending], nnet, eval_cache)
+    expanded = 0
+    for i, p_vec, eval in zip(pending, p_vecs, pending_evals):
+        evals[i] = eval
+        if p_vec is not None:
+            nodes[i].make_children(add_dirichlet(np.array(p_vec)), boards[i])
+            expanded += 1
+            if transpositions is not None:
+                transpositions.store(keys[i], nodes[i])
+
+    return evals, expanded
+
+
+def back_propagate_path(path: List[Node], eval):
+    """
+    Backs eval up the nodes select walked through. With transpositions a node can have
+    several parents, so the path, not the parent pointers, says which edges to update.
+    """
+    for node in reversed(path):
+        node.record(1, eval)
+        eval = -1 * eval
+
+
+def apply_virtual_loss(path: List[Node], loss: int):
+    """
+    Adds loss pending visits, scored as wins for the player to move, to every node on
+    the path so select steers toward other leaves. A negative loss undoes it.
+    """
+    for node in path:
+        node.record(loss, loss)
 
 
 def add_dirichlet(p_vec: np.ndarray) -> np.ndarray:
@@ -63,93 +347,178 @@ def mcts(
     nnet: torch.nn.Module,
     runs: int = 500,
     head_node: Node = None,
+    node_type: type = Node,
+    leaf_batch: int = 1,
+    transpositions: TranspositionTable = None,
+    eval_cache: EvalCache = None,
+    board_cache: BoardCache = None,
+    max_nodes: int = None,
+    deadline: float = None,
+    stats: dict = None,
+    stop: threading.Event = None,
 ):
     """
     gets best move
 
+    node_type picks the tree backend for a fresh search, Node or common.array_tree.ArrayNode
+
+    leaf_batch > 1 collects up to that many leaves per round using virtual loss and
+    evaluates them in one forward pass, each leaf counting as one of the runs
+
+    transpositions, if given, lets positions reached by different move orders share
+    one expansion; it can be kept across moves of the same game
+
+    eval_cache, if given, answers repeated positions without a forward pass and can be
+    kept across moves and games
+
+    board_cache, if given, holds the only copies of non-root boards instead of every
+    node keeping its own, bounding memory for big or reused trees
+
+    max_nodes, if given, caps the expanded nodes of the tree by collapsing the least
+    visited leaves whenever it is exceeded
+
+    a reused head_node becomes the root and its siblings' subtrees are released
+
+    deadline, a time.time() value, stops the search after the round in which it
+    passes, returning the best move found so far; runs=None searches until the
+    deadline alone. At least one round is always searched.
+
+    stats, if given, is filled with the simulations completed, the seconds taken and
+    the simulations (one node expanded each) per second
+
     returns next board, normalized values, index of move
     """
     start = time.time()
     forward_time = 0
 
     sf = time.time()
-    p_vec, eval = get_output(head_board, nnet)
+    p_vec, eval = get_output(head_board, nnet, eval_cache)
     forward_time += time.time() - sf
 
     if head_node is None:
-        head = Node()
+        head = node_type()
         head.board = head_board
         head.make_children(add_dirichlet(np.array(p_vec)))
         head.n = 0
+        if transpositions is not None:
+            transpositions.store(head_board.zobrist_hash(), head)
     else:
-        head = head_node
-        head.parent = None
-        head.child_index = None
-        head.p = None
-
-        runs = runs - head_node.n
+        head = head_node.promote(release=transpositions is None)
+        head.board = head_board
 
-    for _ in range(runs):
-        sim_node = select(head)
-        sim_board = get_board(sim_node)
+        if runs is not None:
+            runs = runs - head.n
+
+    expanded = len(expanded_nodes(head)) if max_nodes else 0
+
+    assert runs is not None or deadline is not None, "a search needs runs or a deadline"
+    runs = np.inf if runs is None else runs
+
+    sims = 0
+    while sims < runs and (sims == 0 or not out_of_time(deadline, stop)):
+        sim_nodes = []
+        sim_paths = []
+        for _ in range(int(min(leaf_batch, runs - sims))):
+            path = []
+            sim_node = select(head, path)
+            if sim_node in sim_nodes:  # every other path is blocked by virtual loss
+                break
+            if leaf_batch > 1:
+                apply_virtual_loss(path, VIRTUAL_LOSS)
+            sim_nodes.append(sim_node)
+            sim_paths.append(path)
+
+        sim_boards = [get_board(sim_node, board_cache) for sim_node in sim_nodes]
         sf = time.time()
-        p_vec, eval = get_output(sim_board, nnet)
+        evals, new_nodes = expand_leaves(
+            sim_nodes, sim_boards, nnet, transpositions, eval_cache
+        )
         forward_time += time.time() - sf
-        if p_vec is None:
-            sim_node.back_propagate(eval)
-        else:
-            sim_node.back_propagate(eval)
-            sim_node.make_children(add_dirichlet(np.array(p_vec)))
 
-    values = np.array(
-        [-node.value_score() if node is not None else -np.inf for node in head.children]
-    )
-    es = np.exp(values)
-    values = es / sum(es)
+        for path, eval in zip(sim_paths, evals):
+            if leaf_batch > 1:
+                apply_virtual_loss(path, -VIRTUAL_LOSS)
+            back_propagate_path(path, eval)
+        sims += len(sim_nodes)
 
-    index = np.argmax(values)
+        if max_nodes:
+            expanded += new_nodes
+            head, expanded = enforce_node_budget(
+                head, expanded, max_nodes, compact=transpositions is None
+            )
+
+    values, slot = move_values(head)
+    best = head.child(slot)
+    index = best.child_index
 
     tot = time.time() - start
     # print(f"Tot: {tot}, f: {forward_time}, percent = {forward_time/tot*100}%")
-    return get_board(head.children[index]), values, index, head.children[index]
+    if stats is not None:
+        stats["sims"] = sims
+        stats["seconds"] = tot
+        stats["forward_seconds"] = forward_time
+        stats["nodes_per_sec"] = sims / tot if tot > 0 else 0.0
+    return get_board(best, board_cache), values, index, best
 
 
-def select(tree: Node) -> Node:
-    def _ucb(tree: Node) -> np.float64:
-        # cbase = 19562
-        # cinit = 1.25
+def out_of_time(deadline: float = None, stop: threading.Event = None) -> bool:
+    if deadline is not None and time.time() >= deadline:
+        return True
+    return stop is not None and stop.is_set()
 
-        # this is classic ucb, I think alphazero implements a slightly altered version
-        if tree == None:
-            return -np.inf
 
-        return tree.p * np.sqrt(tree.parent.n) / (tree.n + 1) - tree.value_score()
+def select(tree: Node, path: List[Node] = None) -> Node:
+    """
+    Descends from tree to a leaf, picking the child with the highest ucb at every level
 
-    if tree.children is None or sum(tree.board.legal_moves()) == 0:
-        return tree
+    if path is given, every node visited (tree and leaf included) is appended to it
+    """
+    node = tree
+    if path is not None:
+        path.append(node)
+    while not node.is_leaf():
+        _, p, n, w = node.child_stats()
+        scores = puct(p, n, w, node.n)
+        favorite = np.argmax(scores)
 
-    max_ucb = _ucb(tree.children[0])
-    favorite_child = tree.children[0]
-    for child in tree.children:
-        current_ucb = _ucb(child)
-        if current_ucb > max_ucb:
-            max_ucb = current_ucb
-            favorite_child = child
+        if scores[favorite] == -np.inf:
+            raise Exception("No max UCB")
+
+        node = node.child(favorite)
+        if path is not None:
+            path.append(node)
+
+    return node
 
-    if max_ucb == -np.inf:
-        raise Exception("No max UCB")
 
-    return select(favorite_child)
+def get_board(node: Node, board_cache: BoardCache = None) -> BlankBoard:
+    """
+    Without a board cache every node keeps the board it was built with. With one, only
+    roots keep theirs; other boards live in the bounded cache and are rebuilt by
+    replaying moves from the nearest ancestor whose board is at hand.
+    """
+    if board_cache is None:
+        if node.board is None:
+            assert node.parent.board.legal_moves()[
+                node.child_index
+            ], "making board from illegal move"
+            node.board = node.parent.board.move_from_int(node.child_index)
+
+        return node.board
 
+    board = node.board if node.board is not None else board_cache.lookup(node)
+    replay = []
+    while board is None:
+        replay.append(node)
+        node = node.parent
+        board = node.board if node.board is not None else board_cache.peek(node)
 
-def get_board(node: Node) -> BlankBoard:
-    if node.board is None:
-        assert node.parent.board.legal_moves()[
-            node.child_index
-        ], "making board from illegal move"
-        node.board = node.parent.board.move_from_int(node.child_index)
+    for child in reversed(replay):
+        board = board.move_from_int(child.child_index)
+        board_cache.store(child, board)
+    board_cache.replayed += len(replay)
 
-    return node.board
+    return board
 
 
 def print_tree(tree: Node, depth: int = 0):
@@ -166,4 +535,5 @@ def print_tree(tree: Node, depth: int = 0):
         return
 
     for child in tree.children:
-        print_tree(child, depth=depth + 1)
+        if child is not None:
+            print_tree(child, depth=depth + 1)
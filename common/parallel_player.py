@@ -1,20 +1,42 @@
 import torch
 from tqdm import tqdm
+from common.adjudicator import Adjudicator
 from common.board import BlankBoard
-from common.pmcts import Parallel_MCTS
+from common.board_cache import BoardCache
+from common.eval_cache import EvalCache
+from common.inference_server import InferenceServer
+from common.pmcts import MultiGame_MCTS
+from common.resignation import Resignation
+from common.self_play_scheduler import SelfPlayScheduler
 from common.training_player import TrainingPlayer
-from common.training_util import GameDataset, save_idxs
+from common.training_util import (
+    BENCHMARK_FILE,
+    GameDataset,
+    append_to_recent_key,
+    game_data,
+    save_idxs,
+)
 from typing import Type
 import torch.nn as nn
-import json
-import time
+import queue
+import signal
+import threading
 
 import torch.multiprocessing as mp
-from torch.multiprocessing import Queue, Process, Value
+from torch.multiprocessing import Queue
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-LOG_FILE = "manual.json"
+WORKER_TIMEOUT = 1  # seconds between checks that the self-play workers are alive
+CANCEL_SIGNALS = [signal.SIGINT, signal.SIGTERM]  # signals that cancel self-play
+
+
+def ignore_interrupts():
+    """
+    Leaves Ctrl-C to the parent, which cancels self-play through the stop event, so
+    worker and server processes keep going until told to stop, however started
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
 class ParallelPlayer(TrainingPlayer):
@@ -28,73 +50,176 @@ class ParallelPlayer(TrainingPlayer):
         Net: Type[nn.Module],
         Board: Type[BlankBoard],
         benchmark=False,
+        eval_cache_bytes=0,
+        board_cache_size=0,
+        max_tree_nodes=0,
+        inference_server=False,
+        server_batch=1024,
+        server_wait=0.002,
+        continuous_slots=0,
+        pipelined=False,
+        adjudicator_workers=4,
+        adjudicator_timeout=None,
+        resign_threshold=None,
+        resign_moves=5,
+        resign_playout=0.1,
     ):
+        """
+        eval_cache_bytes > 0 keeps a network output cache of that size for self-play,
+        shared by every game a process plays and emptied when the next iteration's
+        network takes over
+
+        board_cache_size > 0 stops search nodes from keeping their own boards, holding
+        at most that many rebuilt boards per batch of games instead
+
+        max_tree_nodes > 0 caps the expanded nodes of every game's search tree,
+        evicting the least visited leaves past it
+
+        inference_server runs the network of multicore self-play in one server process,
+        which batches the positions of every worker up to server_batch of them or
+        server_wait seconds, see common.inference_server
+
+        continuous_slots > 0 plays self-play games through a SelfPlayScheduler with
+        that many games in progress at once, starting a new game whenever one ends
+        instead of moving every game in lockstep
+
+        pipelined overlaps the forward pass of half the games with the tree search of
+        the other half, see MultiGame_MCTS.play_pipelined
+
+        adjudicator_workers bounds the threads evaluating slow terminal positions (an
+        engine call each for chess past the move limit), each given at most
+        adjudicator_timeout seconds before it is scored a draw, see common.adjudicator
+
+        resign_threshold, if given, ends a self-play game once its root value has
+        favoured one player by that much for resign_moves moves in a row, playing out
+        resign_playout of the games anyway, see common.resignation
+        """
         super().__init__(
             mcts_iter, old_exists, SAVE_DIR, TEMP_NAME, multicore, Net, Board
         )
         self.benchmark = benchmark
+        self.eval_cache = EvalCache(eval_cache_bytes) if eval_cache_bytes > 0 else None
+        # bumped for every self-play network, see weights_fingerprint
+        self.generation = 0
+        self.board_cache_size = board_cache_size
+        self.max_tree_nodes = max_tree_nodes
+        self.inference_server = inference_server
+        self.server_batch = server_batch
+        self.server_wait = server_wait
+        self.continuous_slots = continuous_slots
+        self.pipelined = pipelined
+        self.stop_event = None
+        self.adjudicator = Adjudicator(adjudicator_workers, adjudicator_timeout)
+        self.resignation = None
+        if resign_threshold is not None:
+            self.resignation = Resignation(
+                resign_threshold, resign_moves, resign_playout
+            )
 
     def generate_self_games(self, num):
+        self.generation += 1
+        if self.resignation is not None:
+            self.resignation.reset()
         if self.multicore > 1:
-            return self.parallel_self_play(num)
-        return self.serial_self_play(num)
+            games = self.parallel_self_play(num)
+        else:
+            games = self.serial_self_play(num)
+        self.report_adjudicator_stats()
+        self.report_resignation_stats()
+        return games
 
     def generate_eval_games(
         self, num, iteration, candidate_net, old_net, candidate_net_file
     ):
+        """
+        candidate_net_file is unused, kept to match TrainingPlayer: the arena plays
+        candidate_net itself in this process, see arena_eval
+        """
         if self.benchmark:  # SKIP EVALUATION
             return 0, [0, 0, 0]
 
-        if self.multicore > 1:
-            return self.parallel_eval(
-                num, iteration, candidate_net, old_net, candidate_net_file
-            )
-        return self.serial_eval(num, iteration, candidate_net, old_net)
+        return self.arena_eval(num, iteration, candidate_net, old_net)
 
     def play_games_in_parallel(
-        self, num, net0, net1, self_play=False, telemetry=False, desc="Eval"
+        self,
+        num,
+        net0,
+        net1,
+        self_play=False,
+        telemetry=False,
+        desc="Eval",
+        arena=False,
+        on_game=None,
+        stop=None,
     ):
-        games = [self.Board.from_start() for _ in range(num)]
+        """
+        net0 plays first in every game, or only in the even games with arena, where
+        net1 plays first in the odd ones, so both networks search every round
+
+        In self-play, on_game is called with the training data of each game as soon as
+        it ends, and games still running once the event stop is set are dropped
+        """
+        if self_play and self.continuous_slots > 0:
+            return self.play_games_continuously(num, net0, telemetry, on_game, stop)
+
         results = [2 for _ in range(num)]
-        finished = [False for _ in range(num)]
         turn = 0
 
         boards = [[] for _ in range(num)]  # boards[i] is the list of moves from game i
         pis = [[] for _ in range(num)]
         idxs = [[] for _ in range(num)]
-        current_trees = [None for _ in range(num)]
+        t_datas = [[] for _ in range(num)]
+        resign = [None] * num
+        if self_play and self.resignation is not None:
+            resign = [self.resignation.start() for _ in range(num)]
+        board_cache = (
+            BoardCache(self.board_cache_size) if self.board_cache_size > 0 else None
+        )
+        mcts = MultiGame_MCTS(
+            games=num,
+            runs=self.mcts_iter,
+            benchmark=self.benchmark,
+            telemetry=telemetry,
+            eval_cache=self.eval_cache if self_play else None,
+            board_cache=board_cache,
+            max_nodes=self.max_tree_nodes or None,
+            pipelined=self.pipelined,
+            adjudicator=self.adjudicator,
+        )
+        for i in range(num):
+            mcts.new_game(i, self.Board.from_start())
         if telemetry:
             pbar = tqdm(desc=f"{desc} - Moves Played", total=100)
         while 2 in results:
-            for i in range(num):
-                if results[i] != 2:
-                    games[i] = self.Board.from_start()
-                    current_trees[i] = None
-                    finished[i] = True
-
-            mcts = Parallel_MCTS(
-                games=num,
-                net=net0 if turn == 0 else net1,
-                runs=self.mcts_iter,
-                first_boards=games,
-                passed_trees=current_trees,
-                finished_games=finished,
-                benchmark=self.benchmark,
-                telemetry=telemetry,
-            )
-            first_boards, moves, mpis, midxs, mcurrent_trees = mcts.play()
+            if stop is not None and stop.is_set():
+                break
+            if arena:
+                nets = [net0 if (i + turn) % 2 == 0 else net1 for i in range(num)]
+            else:
+                nets = net0 if turn == 0 else net1
+            first_boards, games, mpis, midxs = mcts.play(nets)
             turn = 1 if turn == 0 else 0
-            games = moves
-            for i, (fb, pi, idx, tree) in enumerate(
-                zip(first_boards, mpis, midxs, mcurrent_trees)
-            ):
+            running = [i for i in range(num) if results[i] == 2]
+            ends = self.adjudicator.terminal_evals([games[i] for i in running])
+            for i, end in zip(running, ends):
+                boards[i].append(first_boards[i])
+                pis[i].append(mpis[i])
+                idxs[i].append(midxs[i])
+                if end == 2 and resign[i] is not None:
+                    value = mcts.trees[i].value_score()
+                    end = self.resignation.update(resign[i], value, len(boards[i]) - 1)
+                results[i] = end
                 if results[i] == 2:
-                    boards[i].append(fb)
-                    pis[i].append(pi)
-                    idxs[i].append(idx)
+                    # the other net's tree is no use to the next player in eval games
+                    mcts.advance(i, midxs[i], reuse=self_play)
+                else:
+                    mcts.end_game(i)
+                    if resign[i] is not None:
+                        self.resignation.finish(resign[i], results[i], len(boards[i]))
                     if self_play:
-                        current_trees[i] = tree
-                    results[i] = games[i].terminal_eval()
+                        t_datas[i] = game_data(results[i], boards[i], pis[i])
+                        if on_game is not None:
+                            on_game(t_datas[i])
             if telemetry:
                 pbar.update(1)
                 # print(games[0].board)
@@ -102,12 +227,6 @@ class ParallelPlayer(TrainingPlayer):
         if not self_play:
             return results, idxs[0]
 
-        t_datas = [[] for _ in range(num)]
-        for i, (result, seq_boards, seq_pis) in enumerate(zip(results, boards, pis)):
-            for j, (board, pi) in enumerate(zip(seq_boards, seq_pis)):
-                reward = result if j % 2 == 0 else -result
-                t_datas[i].append((board, pi, [float(reward)]))
-
         training_data = []
         [training_data.extend(t_data) for t_data in t_datas]
 
@@ -115,6 +234,30 @@ class ParallelPlayer(TrainingPlayer):
 
         return training_data, ret_idxs
 
+    def play_games_continuously(
+        self, num, net, telemetry=False, on_game=None, stop=None
+    ):
+        board_cache = (
+            BoardCache(self.board_cache_size) if self.board_cache_size > 0 else None
+        )
+        scheduler = SelfPlayScheduler(
+            net,
+            self.Board,
+            runs=self.mcts_iter,
+            slots=self.continuous_slots,
+            games=num,
+            eval_cache=self.eval_cache,
+            board_cache=board_cache,
+            max_nodes=self.max_tree_nodes or None,
+            benchmark=self.benchmark,
+            telemetry=telemetry,
+            on_game=on_game,
+            stop=stop,
+            adjudicator=self.adjudicator,
+            resignation=self.resignation,
+        )
+        return scheduler.play()
+
     def serial_self_play(self, num):
         net = self.Net().to(device)
         if self.old_exists:
@@ -122,6 +265,7 @@ class ParallelPlayer(TrainingPlayer):
                 torch.load(self.temp_name, map_location=torch.device(device))
             )
         net.eval()
+        net.generation = self.generation
 
         all_data, idxs = self.play_games_in_parallel(
             num, net, net, self_play=True, telemetry=True, desc="SP"
@@ -136,119 +280,213 @@ class ParallelPlayer(TrainingPlayer):
                 torch.load(self.temp_name, map_location=torch.device(device))
             )
         net.eval()
-
-        queues = [Queue() for _ in range(self.multicore - 1)]
-        stop_sigs = [Value("i", 0) for _ in range(self.multicore - 1)]
-
-        with open(LOG_FILE, "w") as file:
-            json.dump({"status": "started"}, file, indent=4)
-
-        processes = [
-            mp.Process(
-                target=self.self_play_games_wrapper,
-                args=(stop_sigs[i], queues[i], num, True),
+        net.generation = self.generation
+
+        results = Queue()
+        self.stop_event = mp.Event()
+        handlers = self.handle_cancel_signals()
+
+        server = None
+        try:
+            clients = [None] * self.multicore
+            if self.inference_server:
+                server = InferenceServer(
+                    net,
+                    self.Board.from_start().to_tensor(),
+                    clients=self.multicore,
+                    client_batch=num,
+                    max_batch=self.server_batch,
+                    max_wait=self.server_wait,
+                )
+                server.start()
+                clients = [server.client(i) for i in range(self.multicore)]
+
+            processes = [
+                mp.Process(
+                    target=self.self_play_games_wrapper,
+                    args=(i, self.stop_event, results, num, True, clients[i + 1]),
+                )
+                for i in range(self.multicore - 1)
+            ]
+
+            [process.start() for process in processes]
+
+            play_net = net if server is None else clients[0]
+            all_data, idxs = self.play_games_in_parallel(
+                num,
+                play_net,
+                play_net,
+                self_play=True,
+                telemetry=True,
+                desc="SP",
+                stop=self.stop_event,
             )
-            for i in range(self.multicore - 1)
-        ]
-
-        [process.start() for process in processes]
-
-        all_data, idxs = self.play_games_in_parallel(
-            num, net, net, self_play=True, telemetry=True, desc="SP"
-        )
-
-        while not all(stop_sig.value == 1 for stop_sig in stop_sigs):
-            with open(LOG_FILE, "r") as file:
-                data = json.load(file)
-
-            if data["status"] == "stop":
-                for stop_sig in stop_sigs:
-                    print(stop_sig)
-                    print(stop_sig.value)
-                break
-            st = time.time()
-            while time.time() - st < 5:
+            all_data.extend(self.collect_worker_games(results, processes))
+
+            [process.join() for process in processes]
+
+            return net, GameDataset(all_data), idxs
+        except BaseException:
+            self.cancel()  # so the workers finish their move and exit
+            raise
+        finally:
+            if server is not None:
+                self.report_server_stats(server.stop())
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def cancel(self):
+        """
+        Ends parallel self-play early, from another thread or a signal handler: every
+        process stops after its current move and only its finished games are kept
+        """
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def handle_cancel_signals(self) -> dict:
+        """
+        Makes CANCEL_SIGNALS (Ctrl-C, kill) call cancel() instead of ending the run, so
+        an operator can stop self-play and keep the finished games. A second signal
+        goes to the handler it replaced.
+
+        returns the replaced handlers, by signal
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+
+        replaced = {}
+
+        def cancel(signum, frame):
+            print("Cancelling self-play, signal again to stop at once")
+            signal.signal(signum, replaced[signum])
+            self.cancel()
+
+        for signum in CANCEL_SIGNALS:
+            replaced[signum] = signal.getsignal(signum) or signal.SIG_DFL
+            signal.signal(signum, cancel)
+        return replaced
+
+    def collect_worker_games(self, results, processes) -> list:
+        """
+        Gathers the training data the workers put on results one game at a time, until
+        each has sent its end marker or died without one. The resignation counts that
+        come with the end markers are added to this process's.
+        """
+        all_data = []
+        running = set(range(len(processes)))
+        while running:
+            try:
+                worker, data, counts = results.get(timeout=WORKER_TIMEOUT)
+            except queue.Empty:
+                for worker in [w for w in running if not processes[w].is_alive()]:
+                    print(f"Self-play worker {worker} exited without finishing")
+                    running.discard(worker)
                 continue
+            if data is None:
+                running.discard(worker)
+                if counts is not None:
+                    self.resignation.add(counts)
+            else:
+                all_data.extend(data)
+        return all_data
+
+    def report_adjudicator_stats(self):
+        stats = self.adjudicator.stats()
+        if not self.benchmark or stats["evaluations"] == 0:
+            return
+
+        cache = self.Board.adjudication_stats()
+        if cache is not None:
+            with open(BENCHMARK_FILE, "a") as f:
+                f.write(
+                    f"Adjudication Cache: {cache['entries']}, Hits: {cache['hits']}, Misses: {cache['misses']}, Hit Rate = {round(cache['hit_rate']*100, 2)}%\n"
+                )
+                f.write(
+                    f"Adjudication Tiers: {cache['tiers']}, Engine Avoided = {round(cache['engine_avoided']*100, 2)}%\n"
+                )
+            append_to_recent_key("adjudication_cache_hit_rate", cache["hit_rate"])
+            append_to_recent_key("adjudication_engine_avoided", cache["engine_avoided"])
+
+        with open(BENCHMARK_FILE, "a") as f:
+            f.write(
+                f"Adjudicator: Evaluations: {stats['evaluations']}, Duplicates: {stats['duplicates']}, Timeouts: {stats['timeouts']}, Errors: {stats['errors']}\n"
+            )
+            f.write(
+                f"Adjudication Latency: Mean {round(stats['latency_ms_mean'], 2)}ms, P50 {round(stats['latency_ms_p50'], 2)}ms, P90 {round(stats['latency_ms_p90'], 2)}ms, P99 {round(stats['latency_ms_p99'], 2)}ms\n"
+            )
+        append_to_recent_key("adjudication_ms_p50", stats["latency_ms_p50"])
+        append_to_recent_key("adjudication_ms_p99", stats["latency_ms_p99"])
+        append_to_recent_key("adjudication_timeouts", stats["timeouts"])
 
-        [process.join(timeout=1) for process in processes]
-
-        for queue in queues:
-            proc_data = queue.get()
-            all_data.extend(proc_data)
-            del queue
+    def report_resignation_stats(self):
+        if self.resignation is None:
+            return
 
-        return net, GameDataset(all_data), idxs
+        print(self.resignation.summary(self.mcts_iter))
+        if self.benchmark:
+            self.resignation.report(self.mcts_iter)
 
-    def self_play_games_wrapper(self, stop_sig, queue, num, self_play):
-        # may not be able to pass the network into the new function because it can't be pickled
+    def report_server_stats(self, stats):
+        if not self.benchmark or stats is None:  # None if the server died
+            return
 
-        net = self.Net().to(device)
-        if self.old_exists:
-            net.load_state_dict(
-                torch.load(self.temp_name, map_location=torch.device(device))
+        with open(BENCHMARK_FILE, "a") as f:
+            f.write(
+                f"Inference Server: Batches: {stats['batches']}, Mean Batch: {round(stats['mean_batch'], 1)}, Histogram: {stats['batch_histogram']}\n"
             )
-        net.eval()
-
-        print("Parallel Start")
-        all_data, _ = self.play_games_in_parallel(num, net, net, self_play, desc="SP")
-        queue.put(all_data, block=False)
-        queue.put(None, block=False)
-        stop_sig.value = 1
-        print("Parallel End")
+            f.write(
+                f"Queue Latency: Mean {round(stats['queue_ms_mean'], 2)}ms, P50 {round(stats['queue_ms_p50'], 2)}ms, P99 {round(stats['queue_ms_p99'], 2)}ms\n"
+            )
+        append_to_recent_key("server_mean_batch", stats["mean_batch"])
+        append_to_recent_key("server_batch_histogram", stats["batch_histogram"])
+        append_to_recent_key("server_queue_ms_p50", stats["queue_ms_p50"])
+        append_to_recent_key("server_queue_ms_p99", stats["queue_ms_p99"])
 
-    def serial_eval(self, num, iteration, net, old_net):
-        score = 0
-        res = [0] * 3
+    def self_play_games_wrapper(self, worker, stop, results, num, self_play, net=None):
+        # may not be able to pass the network into the new function because it can't be pickled
+        # net, if given, is an InferenceClient of the shared server
+        # each finished game goes on results as (worker, data, None), then at the end
+        # (worker, None, resignation counts) with counts None when resigning is off
+        ignore_interrupts()
+        self.Board.use_save_dir(self.save_dir)  # a spawned worker re-imports the board
+        if self.resignation is not None:
+            self.resignation.reset()  # the parent's games are its own to count
+
+        if net is None:
+            net = self.Net().to(device)
+            if self.old_exists:
+                net.load_state_dict(
+                    torch.load(self.temp_name, map_location=torch.device(device))
+                )
+            net.eval()
 
-        w_results, idxs = self.play_games_in_parallel(
-            num // 2, net, old_net, False, telemetry=True
-        )
-        b_results, _ = self.play_games_in_parallel(
-            num // 2, old_net, net, False, telemetry=True
+        print("Parallel Start")
+        self.play_games_in_parallel(
+            num,
+            net,
+            net,
+            self_play,
+            desc="SP",
+            on_game=lambda data: results.put((worker, data, None)),
+            stop=stop,
         )
+        counts = None if self.resignation is None else self.resignation.counts()
+        results.put((worker, None, counts))
+        print("Parallel End")
 
-        for result in w_results:
-            if result == 1:
-                res[0] += 1
-            if result == 0:
-                res[1] += 1
-            if result == -1:
-                res[2] += 1
-            score += result
-
-        for result in b_results:
-            if result == -1:
-                res[0] += 1
-            if result == 0:
-                res[1] += 1
-            if result == 1:
-                res[2] += 1
-            score -= result
-        save_idxs(self.save_dir, idxs, f"e{iteration}")
-
-        return score, res
-
-    def parallel_eval(self, num, iteration, net, old_net, fp):
+    def arena_eval(self, num, iteration, net, old_net):
+        """
+        Plays num games of net against old_net in one process, net moving first in the
+        even games and old_net in the odd ones
+        """
         score = 0
         res = [0] * 3
 
-        queue = Queue()
-        stop_signal = Value("i", 0)
-
-        process = Process(
-            target=self.eval_games_wrapper,
-            args=(queue, stop_signal, num, fp),
-        )
-        process.start()
-
-        w_results, idxs = self.play_games_in_parallel(
-            num // 2, net, old_net, False, telemetry=True
+        results, idxs = self.play_games_in_parallel(
+            num // 2 * 2, net, old_net, False, telemetry=True, arena=True
         )
-
-        while stop_signal.value == 0:
-            continue
-        process.join(timeout=1)
-        b_results = queue.get()
+        w_results = results[0::2]
+        b_results = results[1::2]
 
         for result in w_results:
             if result == 1:
@@ -270,17 +508,3 @@ class ParallelPlayer(TrainingPlayer):
         save_idxs(self.save_dir, idxs, f"e{iteration}")
 
         return score, res
-
-    def eval_games_wrapper(self, queue, stop_sig, GAMES_TO_EVAL, fp):
-        net = self.Net().to(device)
-        net.load_state_dict(torch.load(fp, map_location=torch.device(device)))
-
-        old_net = self.Net().to(device)
-        if self.old_exists:
-            old_net.load_state_dict(torch.load(self.temp_name))
-
-        b_results, _ = self.play_games_in_parallel(
-            GAMES_TO_EVAL // 2, old_net, net, False
-        )
-        queue.put(b_results)
-        stop_sig.value = 1
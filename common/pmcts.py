@@ -3,14 +3,31 @@ from common.board import BlankBoard
 import torch
 from typing import List
 from tqdm import tqdm
-from common.mcts import select, add_dirichlet, get_board, Node, get_output
-import threading
+from common.mcts import (
+    select,
+    add_dirichlet,
+    get_board,
+    Node,
+    get_output,
+    back_propagate_path,
+    move_values,
+    transpose,
+)
+from common.adjudicator import Adjudicator
+from common.board_cache import BoardCache
+from common.eval_cache import EvalCache
+from common.input_buffer import InputBuffer
+from common.transposition import TranspositionTable
+from common.tree_gc import enforce_node_budget, expanded_nodes, tree_nbytes
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from common.training_util import BENCHMARK_FILE, append_to_recent_key
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+ADJUDICATOR = Adjudicator()  # slow terminal evals of searches not given their own
+
 
 class Parallel_MCTS:
     def __init__(
@@ -23,27 +40,49 @@ class Parallel_MCTS:
         finished_games: List[bool],
         benchmark: bool,
         telemetry: bool,
+        node_type: type = Node,
+        transpositions: TranspositionTable = None,
+        eval_cache: EvalCache = None,
+        board_cache: BoardCache = None,
+        max_nodes: int = None,
     ):
+        """
+        transpositions, if given, is shared by all games, so a position reached in
+        several games (or by several move orders) is expanded and evaluated once
+
+        eval_cache, if given, answers positions seen in earlier moves or games
+        without a forward pass
+
+        board_cache, if given, is shared by all games and holds the only copies of
+        non-root boards, see get_board
+
+        a passed tree becomes the root of its game and its siblings' subtrees are
+        released; max_nodes, if given, caps the expanded nodes of every game's tree
+        """
         self.benchmark = benchmark
         self.telemetry = telemetry
         self.first_boards = first_boards
         self.net = net
+        self.transpositions = transpositions
+        self.eval_cache = eval_cache
+        self.board_cache = board_cache
+        self.max_nodes = max_nodes
+        self.input_buffer = InputBuffer(games)
         self.runs = np.array([runs] * games)
-        self.board_shape = first_boards[0].to_tensor().shape
         p_vecs, _ = self.parallel_pass(first_boards)
         self.trees = [None] * games
         for i in range(games):
             if passed_trees[i] is None:
-                node = Node()
+                node = node_type()
                 node.board = first_boards[i]
                 node.make_children(add_dirichlet(np.array(p_vecs[i])))
                 node.n = 0
                 self.trees[i] = node
+                if transpositions is not None:
+                    transpositions.store(first_boards[i].zobrist_hash(), node)
             else:
-                node = passed_trees[i]
-                node.parent = None
-                node.child_index = None
-                node.p = None
+                node = passed_trees[i].promote(release=transpositions is None)
+                node.board = first_boards[i]
 
                 self.runs[i] = max(self.runs[i] - node.n, 3)
                 self.trees[i] = node
@@ -51,6 +90,10 @@ class Parallel_MCTS:
             if fin:
                 self.runs[i] = 1
 
+        self.expanded = [
+            len(expanded_nodes(tree)) if max_nodes else 0 for tree in self.trees
+        ]
+
         self.games = games
         self.max_runs = max(self.runs)
 
@@ -58,64 +101,10 @@ class Parallel_MCTS:
         return self.runs[i] > 0
 
     def parallel_pass(self, boards: List[BlankBoard]):
-        """
-        returns 2 vectors, p_vecs and evals
+        return parallel_pass(boards, self.net, self.eval_cache, self.input_buffer)
 
-        outputs random if the board is None, meaning that move calculation is out of runs
-        if board is in terminal state, outputs None in that entry of p_vecs
-        """
-        tensors = torch.stack(
-            [
-                (
-                    board.to_tensor()
-                    if board is not None
-                    else torch.randn(self.board_shape)
-                )
-                for board in boards
-            ],
-            dim=0,
-        ).to(device)
-        p_vecs, evals = self.net(tensors)
-        p_vecs = p_vecs.detach().cpu().numpy()
-        evals = evals.detach().cpu().numpy()[:, 0]
-        player_perspective_evals = self.parallel_player_perspective_evals(boards)
-        for i, board in enumerate(boards):
-            if board is not None and player_perspective_evals[i] != 2:
-                p_vecs[i] = None
-                evals[i] = player_perspective_evals[i]
-        return p_vecs, evals
-    
     def parallel_player_perspective_evals(self, boards):
-        results = [3] * len(boards)
-        
-        def player_perspective_eval_wrapper(board, index):
-            try:
-                results[index] = board.player_perspective_eval()
-            except Exception as e:
-                results[index] = 2
-                print("Error from the following board")
-                print(e)
-                print(board.board)
-
-        threads = []
-
-        for i, board in enumerate(boards):
-            if board is None:
-                results[i] = 2
-            elif board.terminal_slow():
-                thread = threading.Thread(target=player_perspective_eval_wrapper, args=(board, i))
-                threads.append(thread)
-                thread.start()
-            else:
-                results[i] = board.player_perspective_eval()
-                
-        while 3 in results:
-            continue
-
-        for thread in threads:
-            thread.join(timeout=1)
-        return results
-
+        return parallel_player_perspective_evals(boards)
 
     def play(self):
         """
@@ -126,6 +115,8 @@ class Parallel_MCTS:
 
         st = time.time()
         ppt = 0
+        rows = 0  # leaves a padded batch would hold
+        padding = 0  # rows of those skipped instead of padded
         boards = [None] * self.games
         vals = [None] * self.games
         indices = [-1] * self.games
@@ -133,46 +124,479 @@ class Parallel_MCTS:
         # for _ in tqdm(range(self.max_runs)):
         for _ in range(self.max_runs):
             sim_nodes = [None] * self.games
+            sim_paths = [None] * self.games
             sim_boards = [None] * self.games
+            keys = [None] * self.games
+            shared_evals = [None] * self.games
             for i, head in enumerate(self.trees):
                 if self.to_run(i):
-                    n = select(head)
+                    path = []
+                    n = select(head, path)
                     sim_nodes[i] = n
-                    sim_boards[i] = get_board(n)
+                    sim_paths[i] = path
+                    sim_boards[i] = get_board(n, self.board_cache)
+                    if self.transpositions is not None:
+                        shared_evals[i], keys[i] = transpose(
+                            n, sim_boards[i], self.transpositions
+                        )
+                        if shared_evals[i] is not None:
+                            sim_boards[i] = None  # no forward pass needed
 
-            ppts = time.time()
-            p_vecs, evals = self.parallel_pass(sim_boards)
-            ppt += time.time() - ppts
+            # only live leaves go through the network, mapped back to their games
+            live = [i for i, board in enumerate(sim_boards) if board is not None]
+            rows += self.games
+            padding += self.games - len(live)
+            p_vecs = [None] * self.games
+            evals = [None] * self.games
+            if len(live) > 0:
+                ppts = time.time()
+                live_p_vecs, live_evals = self.parallel_pass(
+                    [sim_boards[i] for i in live]
+                )
+                ppt += time.time() - ppts
+                for j, i in enumerate(live):
+                    p_vecs[i] = live_p_vecs[j]
+                    evals[i] = live_evals[j]
             for i, node in enumerate(sim_nodes):
                 if self.to_run(i):
-                    node.back_propagate(evals[i])
-                    if not np.any(np.isnan(p_vecs[i])):
-                        node.make_children(add_dirichlet(np.array(p_vecs[i])))
+                    if shared_evals[i] is not None:
+                        back_propagate_path(sim_paths[i], shared_evals[i])
+                        continue
+
+                    back_propagate_path(sim_paths[i], evals[i])
+                    # with a shared table two games can reach the same leaf in one round
+                    if not np.any(np.isnan(p_vecs[i])) and node.is_leaf():
+                        node.make_children(
+                            add_dirichlet(np.array(p_vecs[i])), sim_boards[i]
+                        )
+                        if self.transpositions is not None:
+                            self.transpositions.store(keys[i], node)
+                        self.expanded[i] += 1
+
+                    if self.max_nodes:
+                        self.trees[i], self.expanded[i] = enforce_node_budget(
+                            self.trees[i],
+                            self.expanded[i],
+                            self.max_nodes,
+                            compact=self.transpositions is None,
+                        )
 
             self.runs -= 1
 
             for i, runs_left in enumerate(self.runs):
                 
                 if runs_left == 0:
-                    values = np.array(
-                        [
-                            -node.value_score() if node is not None else -np.inf
-                            for node in self.trees[i].children
-                        ]
-                    )
-                    es = np.exp(values)
-                    values = es / sum(es)
-                    indices[i] = np.argmax(values)
-                    boards[i] = get_board(self.trees[i].children[indices[i]])
+                    values, slot = move_values(self.trees[i])
+                    next_trees[i] = self.trees[i].child(slot)
+                    indices[i] = next_trees[i].child_index
+                    boards[i] = get_board(next_trees[i], self.board_cache)
                     vals[i] = values
-                    next_trees[i] = self.trees[i].children[indices[i]]
         et = time.time() - st
 
         if self.benchmark and self.telemetry:
-            with open(BENCHMARK_FILE, "a") as f:
-                f.write(
-                    f"Total Time: {round(et, 3)}, Forward Time: {round(ppt, 3)}, F/T = {round(ppt/et*100, 2)}%\n"
-                )
-                append_to_recent_key("percent_forward", ppt / et * 100)
-        
+            write_telemetry(
+                et,
+                ppt,
+                self.trees,
+                self.transpositions,
+                self.eval_cache,
+                padding / rows if rows > 0 else 0.0,
+            )
+
         return self.first_boards, boards, vals, indices, next_trees
+
+
+class MultiGame_MCTS:
+    def __init__(
+        self,
+        games: int,
+        runs: int,
+        benchmark: bool = False,
+        telemetry: bool = False,
+        node_type: type = Node,
+        transpositions: TranspositionTable = None,
+        eval_cache: EvalCache = None,
+        board_cache: BoardCache = None,
+        max_nodes: int = None,
+        pipelined: bool = False,
+        adjudicator: Adjudicator = None,
+    ):
+        """
+        Long-lived search over several games, owning their trees across moves
+
+        Start game i with new_game(i, board), get the best move of every running game
+        from play(net), then move game i on with advance(i, move) or stop it with
+        end_game(i). A root carried over by advance keeps its children and priors, so
+        it is never evaluated again; fresh roots are expanded inside the first batch
+        of the next play.
+
+        transpositions, eval_cache, board_cache and max_nodes work as in Parallel_MCTS
+
+        pipelined overlaps the forward pass of half the games with the tree work of
+        the other half, see play_pipelined
+
+        adjudicator evaluates the leaves whose terminal check is slow, see
+        common.adjudicator
+        """
+        self.games = games
+        self.runs = runs
+        self.benchmark = benchmark
+        self.telemetry = telemetry
+        self.node_type = node_type
+        self.transpositions = transpositions
+        self.eval_cache = eval_cache
+        self.board_cache = board_cache
+        self.max_nodes = max_nodes
+        self.pipelined = pipelined
+        self.adjudicator = adjudicator
+        self.input_buffers = [InputBuffer(games), InputBuffer(games)]
+
+        self.trees = [None] * games
+        self.runs_left = np.zeros(games, dtype=np.int64)
+        self.expanded = np.zeros(games, dtype=np.int64)
+        self.sim_nodes = [None] * games
+        self.sim_paths = [None] * games
+        self.sim_boards = [None] * games
+        self.keys = [None] * games
+        self.shared_evals = [None] * games
+
+    def new_game(self, i: int, board: BlankBoard):
+        self.release(i)
+        tree = self.node_type()
+        tree.board = board
+        self.trees[i] = tree
+        self.expanded[i] = 0
+
+    def end_game(self, i: int):
+        self.release(i)
+        self.trees[i] = None
+
+    def release(self, i: int):
+        if self.trees[i] is not None and self.transpositions is None:
+            self.trees[i].release()
+
+    def board(self, i: int) -> BlankBoard:
+        return None if self.trees[i] is None else self.trees[i].board
+
+    def advance(self, i: int, move: int, reuse: bool = True):
+        """
+        Plays move (its index in the p-vector) in game i. With reuse, the searched
+        subtree of the move becomes the new root, otherwise the search starts afresh.
+        """
+        head = self.trees[i]
+        child = None
+        if reuse and not head.is_leaf():
+            moves, _, _, _ = head.child_stats()
+            slot = np.flatnonzero(moves == move)
+            if len(slot) > 0:
+                child = head.child(slot[0])
+
+        if child is None:
+            self.new_game(i, head.board.move_from_int(move))
+            return
+
+        board = get_board(child, self.board_cache)
+        tree = child.promote(release=self.transpositions is None)
+        tree.board = board
+        self.trees[i] = tree
+        self.expanded[i] = len(expanded_nodes(tree)) if self.max_nodes else 0
+
+    def play(self, net):
+        """
+        searches every running game with net, or with net[i] for game i if it is a list,
+        as in arena games where both networks are to move somewhere every round
+
+        returns List[root board], List[next board], List[normalized values], List[index of move],
+        with None for games not running
+        """
+        st = time.time()
+        ppt = 0
+        rows = 0
+        padding = 0
+        first_boards = [self.board(i) for i in range(self.games)]
+        boards = [None] * self.games
+        vals = [None] * self.games
+        indices = [None] * self.games
+        nets = net if isinstance(net, list) else [net] * self.games
+
+        for i, tree in enumerate(self.trees):
+            if tree is None:
+                self.runs_left[i] = 0
+            elif tree.is_leaf():
+                self.runs_left[i] = self.runs + 1  # the first run expands the root
+            else:
+                self.runs_left[i] = max(self.runs - tree.n, 3)
+
+        results = (boards, vals, indices)
+        if self.pipelined:
+            ppt, rows, padding = self.play_pipelined(nets, results)
+        while np.any(self.runs_left > 0):
+            active = np.flatnonzero(self.runs_left > 0)
+            batch = self.select_leaves(active)
+            rows += self.games
+            padding += self.games - len(batch)
+            p_vecs, evals, seconds = self.evaluate(batch, nets, self.input_buffers[0])
+            ppt += seconds
+            self.back_up(active, batch, p_vecs, evals, results)
+
+        self.sim_nodes = [None] * self.games  # do not pin discarded subtrees
+        self.sim_paths = [None] * self.games
+        et = time.time() - st
+
+        if self.benchmark and self.telemetry:
+            trees = [tree for tree in self.trees if tree is not None]
+            write_telemetry(
+                et,
+                ppt,
+                trees,
+                self.transpositions,
+                self.eval_cache,
+                padding / rows if rows > 0 else 0.0,
+            )
+
+        return first_boards, boards, vals, indices
+
+    def play_pipelined(self, nets: list, results: tuple):
+        """
+        Searches the even and odd games as two groups, so while a worker thread runs
+        one group's forward pass (torch releases the GIL) the main thread backs up and
+        selects the other's leaves. Each group encodes into its own input buffer.
+
+        returns the forward time and the batch rows used and saved
+        """
+        groups = [np.arange(0, self.games, 2), np.arange(1, self.games, 2)]
+        ppt = 0
+        rows = 0
+        padding = 0
+        pending = [None, None]  # per group: (active, batch, future)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while np.any(self.runs_left > 0) or any(pending):
+                for g, group in enumerate(groups):
+                    if pending[g] is not None:
+                        active, batch, future = pending[g]
+                        pending[g] = None
+                        p_vecs, evals, seconds = future.result()
+                        ppt += seconds
+                        self.back_up(active, batch, p_vecs, evals, results)
+
+                    active = group[self.runs_left[group] > 0]
+                    if len(active) == 0:
+                        continue
+                    batch = self.select_leaves(active)
+                    rows += len(group)
+                    padding += len(group) - len(batch)
+                    future = executor.submit(
+                        self.evaluate, batch, nets, self.input_buffers[g]
+                    )
+                    pending[g] = (active, batch, future)
+        return ppt, rows, padding
+
+    def select_leaves(self, active: np.ndarray) -> list:
+        """
+        Selects a leaf in every active game, answering transpositions on the spot
+
+        returns the games whose leaves need the network
+        """
+        for i in active:
+            path = []
+            n = select(self.trees[i], path)
+            self.sim_nodes[i] = n
+            self.sim_paths[i] = path
+            self.sim_boards[i] = get_board(n, self.board_cache)
+            self.shared_evals[i] = None
+            if self.transpositions is not None:
+                self.shared_evals[i], self.keys[i] = transpose(
+                    n, self.sim_boards[i], self.transpositions
+                )
+        return [i for i in active if self.shared_evals[i] is None]
+
+    def evaluate(self, batch: list, nets: list, input_buffer: InputBuffer):
+        """
+        Runs the leaves of batch through the network of their game, one forward pass
+        per network back to back. The eval cache is only used while a single network
+        plays, since its entries are not keyed by network.
+
+        returns p_vecs, evals and the seconds spent, safe to run on another thread
+        """
+        if len(batch) == 0:
+            return None, None, 0.0
+        ppts = time.time()
+        by_net = {}  # id(net) -> positions in batch of the games it plays
+        for j, i in enumerate(batch):
+            by_net.setdefault(id(nets[i]), []).append(j)
+        eval_cache = self.eval_cache if len(by_net) == 1 else None
+
+        p_vecs = [None] * len(batch)
+        evals = np.zeros(len(batch), dtype=np.float32)
+        with torch.no_grad():
+            for rows in by_net.values():
+                net_p_vecs, net_evals = parallel_pass(
+                    [self.sim_boards[batch[j]] for j in rows],
+                    nets[batch[rows[0]]],
+                    eval_cache,
+                    input_buffer,
+                    self.adjudicator,
+                )
+                for k, j in enumerate(rows):
+                    p_vecs[j] = net_p_vecs[k]
+                    evals[j] = net_evals[k]
+        return p_vecs, evals, time.time() - ppts
+
+    def back_up(
+        self,
+        active: np.ndarray,
+        batch: list,
+        p_vecs: np.ndarray,
+        evals: np.ndarray,
+        results: tuple,
+    ):
+        """
+        Backs up and expands the leaves of the active games, playing the best move of
+        every game that runs out of runs into results (boards, values, indices)
+        """
+        boards, vals, indices = results
+        for i in active:
+            if self.shared_evals[i] is not None:
+                back_propagate_path(self.sim_paths[i], self.shared_evals[i])
+        for j, i in enumerate(batch):
+            node = self.sim_nodes[i]
+            back_propagate_path(self.sim_paths[i], evals[j])
+            # with a shared table two games can reach the same leaf in one round
+            if not np.any(np.isnan(p_vecs[j])) and node.is_leaf():
+                node.make_children(
+                    add_dirichlet(np.array(p_vecs[j])), self.sim_boards[i]
+                )
+                if self.transpositions is not None:
+                    self.transpositions.store(self.keys[i], node)
+                self.expanded[i] += 1
+
+        for i in active:
+            if self.max_nodes:
+                self.trees[i], self.expanded[i] = enforce_node_budget(
+                    self.trees[i],
+                    self.expanded[i],
+                    self.max_nodes,
+                    compact=self.transpositions is None,
+                )
+            self.runs_left[i] -= 1
+            if self.runs_left[i] == 0:
+                values, slot = move_values(self.trees[i])
+                best = self.trees[i].child(slot)
+                indices[i] = best.child_index
+                boards[i] = get_board(best, self.board_cache)
+                vals[i] = values
+
+
+def write_telemetry(
+    et: float,
+    ppt: float,
+    trees: list,
+    transpositions: TranspositionTable = None,
+    eval_cache: EvalCache = None,
+    padding: float = None,
+):
+    """padding is the fraction of batch rows that were dropped instead of padded"""
+    with open(BENCHMARK_FILE, "a") as f:
+        f.write(
+            f"Total Time: {round(et, 3)}, Forward Time: {round(ppt, 3)}, F/T = {round(ppt/et*100, 2)}%\n"
+        )
+        append_to_recent_key("percent_forward", ppt / et * 100)
+
+        if padding is not None:
+            f.write(f"Padding Saved: {round(padding*100, 2)}% of batch rows\n")
+            append_to_recent_key("padding_saved", padding)
+
+        if transpositions is not None:
+            stats = transpositions.stats()
+            f.write(
+                f"Transpositions: {stats['entries']}, Hits: {stats['hits']}, Misses: {stats['misses']}, Hit Rate = {round(stats['hit_rate']*100, 2)}%\n"
+            )
+            append_to_recent_key("tt_hit_rate", stats["hit_rate"])
+
+        if eval_cache is not None:
+            write_eval_cache_stats(f, eval_cache)
+
+        tree_nodes = sum(len(expanded_nodes(tree)) for tree in trees)
+        tree_mb = sum(tree_nbytes(tree) for tree in trees) / 2**20
+        f.write(f"Tree Nodes: {tree_nodes}, Tree MB: {round(tree_mb, 2)}\n")
+        append_to_recent_key("tree_nodes", tree_nodes)
+        append_to_recent_key("tree_mb", tree_mb)
+
+
+def write_eval_cache_stats(f, eval_cache: EvalCache):
+    """Appends the hit counts of eval_cache to f, the open benchmark file"""
+    stats = eval_cache.stats()
+    f.write(
+        f"Eval Cache: {stats['entries']}, Hits: {stats['hits']}, Misses: {stats['misses']}, Hit Rate = {round(stats['hit_rate']*100, 2)}%\n"
+    )
+    append_to_recent_key("eval_cache_hits", stats["hits"])
+    append_to_recent_key("eval_cache_misses", stats["misses"])
+
+
+def parallel_pass(
+    boards: List[BlankBoard],
+    net: torch.nn.Module,
+    eval_cache: EvalCache = None,
+    input_buffer: InputBuffer = None,
+    adjudicator: Adjudicator = None,
+):
+    """
+    returns 2 vectors, p_vecs and evals
+
+    every board must be a live leaf; callers leave out games that are out of runs
+    if board is in terminal state, outputs None in that entry of p_vecs
+    with an eval cache, unterminated boards found in it skip the network
+    boards are encoded into input_buffer, which callers keep across rounds
+    """
+    player_perspective_evals = parallel_player_perspective_evals(boards, adjudicator)
+
+    keys = [None] * len(boards)
+    cached = {}
+    if eval_cache is not None:
+        eval_cache.sync(net)
+        for i, board in enumerate(boards):
+            if player_perspective_evals[i] == 2:
+                keys[i] = board.zobrist_hash()
+                hit = eval_cache.lookup(keys[i])
+                if hit is not None:
+                    cached[i] = hit
+
+    p_vecs = [None] * len(boards)
+    evals = np.zeros(len(boards), dtype=np.float32)
+    batch = [i for i in range(len(boards)) if i not in cached]
+    if len(batch) > 0:
+        if input_buffer is None:
+            input_buffer = InputBuffer(len(batch))
+        tensors = input_buffer.encode([boards[i] for i in batch])
+        batch_p_vecs, batch_evals = net(tensors)
+        batch_p_vecs = batch_p_vecs.detach().cpu().numpy()
+        batch_evals = batch_evals.detach().cpu().numpy()[:, 0]
+        for j, i in enumerate(batch):
+            p_vecs[i] = batch_p_vecs[j]
+            evals[i] = batch_evals[j]
+            if keys[i] is not None:
+                eval_cache.store(keys[i], p_vecs[i], evals[i])
+    for i, (p_vec, eval) in cached.items():
+        p_vecs[i] = p_vec
+        evals[i] = eval
+    p_vecs = np.stack(p_vecs)
+
+    for i, board in enumerate(boards):
+        if player_perspective_evals[i] != 2:
+            p_vecs[i] = None
+            evals[i] = player_perspective_evals[i]
+    return p_vecs, evals
+
+
+def parallel_player_perspective_evals(
+    boards: List[BlankBoard], adjudicator: Adjudicator = None
+):
+    """
+    Evaluates every board from its player's perspective, 2 if the game goes on or
+    the board is None
+
+    Boards whose terminal check is slow go to adjudicator, or the shared ADJUDICATOR,
+    which evaluates them together on its bounded pool
+    """
+    adjudicator = ADJUDICATOR if adjudicator is None else adjudicator
+    return adjudicator.player_perspective_evals(boards)
@@ -0,0 +1,143 @@
+import random
+
+from common.training_util import BENCHMARK_FILE, append_to_recent_key
+
+COUNTS = (
+    "games",
+    "moves_played",
+    "resigned",
+    "playouts",
+    "false_resigns",
+    "playout_moves_after",
+)
+
+
+class ResignState:
+    def __init__(self, enabled: bool):
+        """
+        Resignation bookkeeping of one game. Games with enabled unset are played out,
+        only noting when and how they would have resigned.
+        """
+        self.enabled = enabled
+        self.streak = 0
+        self.winner = 0  # 1 or -1 for the first player or the second, 0 for neither
+        self.result = None  # result resigning gave, or would have given
+        self.ply = None  # move it happened at
+
+
+class Resignation:
+    def __init__(self, threshold: float, moves: int = 5, playout: float = 0.1):
+        """
+        Ends a self-play game once the root value has favoured the same player by at
+        least threshold for moves consecutive moves, scoring it a win for them
+
+        A fraction playout of the games is played out anyway, to measure how often
+        resigning would have been wrong and how many moves it saves. Counts are kept
+        over every game given to finish since the last reset.
+        """
+        self.threshold = threshold
+        self.moves = moves
+        self.playout = playout
+        self.reset()
+
+    def reset(self):
+        """Forgets the games finished so far, so counts cover one round of self-play"""
+        self.games = 0
+        self.moves_played = 0
+        self.resigned = 0
+        self.playouts = 0  # played out games that would have resigned
+        self.false_resigns = 0
+        self.playout_moves_after = 0  # moves the playouts went on for after that
+
+    def counts(self) -> dict:
+        """The counts kept so far, for add in another process"""
+        return {name: getattr(self, name) for name in COUNTS}
+
+    def add(self, counts: dict):
+        """Adds the counts of another Resignation, such as a worker process's"""
+        for name in COUNTS:
+            setattr(self, name, getattr(self, name) + counts[name])
+
+    def start(self) -> ResignState:
+        return ResignState(random.random() >= self.playout)
+
+    def update(self, state: ResignState, value: float, ply: int) -> int:
+        """
+        value is the root value searched for the player to move at ply, the move count
+        of the game so far
+
+        returns the result (1 if the first player wins, -1 if the second) when the game
+        ends here by resignation, else 2
+        """
+        if state.result is not None:
+            return 2
+
+        first = value if ply % 2 == 0 else -value
+        winner = 0
+        if abs(first) >= self.threshold:
+            winner = 1 if first > 0 else -1
+        if winner == 0:
+            state.streak = 0
+        elif winner == state.winner:
+            state.streak += 1
+        else:
+            state.streak = 1
+        state.winner = winner
+
+        if state.streak >= self.moves:
+            state.result = winner
+            state.ply = ply
+            if state.enabled:
+                return winner
+        return 2
+
+    def finish(self, state: ResignState, result: int, length: int):
+        """Records a game that ended with result after length moves"""
+        self.games += 1
+        self.moves_played += length
+        if state.result is None:
+            return
+        if state.enabled:
+            self.resigned += 1
+            return
+
+        self.playouts += 1
+        self.playout_moves_after += length - state.ply - 1
+        if result != state.result:
+            self.false_resigns += 1
+
+    def stats(self, runs: int) -> dict:
+        """
+        moves_saved extrapolates the moves the playouts went on for to every resigned
+        game, sims_saved multiplies them by the runs of a move
+        """
+        moves_after = self.playout_moves_after / self.playouts if self.playouts else 0.0
+        moves_saved = self.resigned * moves_after
+        return {
+            "games": self.games,
+            "resigned": self.resigned,
+            "playouts": self.playouts,
+            "false_resign_rate": (
+                self.false_resigns / self.playouts if self.playouts else 0.0
+            ),
+            "mean_length": self.moves_played / self.games if self.games else 0.0,
+            "moves_saved": moves_saved,
+            "sims_saved": moves_saved * runs,
+        }
+
+    def summary(self, runs: int) -> str:
+        stats = self.stats(runs)
+        return f"Resigned {stats['resigned']}/{stats['games']}, False Resigns = {round(stats['false_resign_rate']*100, 2)}%, Mean Length: {round(stats['mean_length'], 1)}, Sims Saved: {round(stats['sims_saved'])}"
+
+    def report(self, runs: int):
+        stats = self.stats(runs)
+        with open(BENCHMARK_FILE, "a") as f:
+            f.write(
+                f"Resignation: Games: {stats['games']}, Resigned: {stats['resigned']}, Playouts: {stats['playouts']}, False Resigns = {round(stats['false_resign_rate']*100, 2)}%\n"
+            )
+            f.write(
+                f"Mean Game Length: {round(stats['mean_length'], 1)}, Moves Saved: {round(stats['moves_saved'])}, Sims Saved: {round(stats['sims_saved'])}\n"
+            )
+        append_to_recent_key("mean_game_length", stats["mean_length"])
+        append_to_recent_key("false_resign_rate", stats["false_resign_rate"])
+        append_to_recent_key("sims_saved", stats["sims_saved"])
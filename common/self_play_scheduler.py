@@ -0,0 +1,218 @@
+import time
+import numpy as np
+import torch
+from tqdm import tqdm
+from typing import Type
+from common.adjudicator import Adjudicator
+from common.board import BlankBoard
+from common.board_cache import BoardCache
+from common.eval_cache import EvalCache
+from common.input_buffer import InputBuffer
+from common.mcts import (
+    Node,
+    add_dirichlet,
+    back_propagate_path,
+    get_board,
+    move_values,
+    select,
+)
+from common.pmcts import parallel_pass, write_eval_cache_stats
+from common.resignation import Resignation
+from common.training_util import BENCHMARK_FILE, append_to_recent_key, game_data
+from common.tree_gc import enforce_node_budget, expanded_nodes
+
+
+class GameSlot:
+    def __init__(
+        self, game: int, board: BlankBoard, node_type: type, runs: int, resign=None
+    ):
+        """
+        One game in progress: its search tree, the moves played so far and its
+        resignation state, if any
+        """
+        self.game = game
+        self.tree = node_type()
+        self.tree.board = board
+        self.runs = runs + 1  # the first run expands the root
+        self.expanded = 0
+        self.boards = []
+        self.pis = []
+        self.idxs = []
+        self.resign = resign
+
+
+class SelfPlayScheduler:
+    def __init__(
+        self,
+        net: torch.nn.Module,
+        Board: Type[BlankBoard],
+        runs: int,
+        slots: int,
+        games: int,
+        node_type: type = Node,
+        eval_cache: EvalCache = None,
+        board_cache: BoardCache = None,
+        max_nodes: int = None,
+        benchmark: bool = False,
+        telemetry: bool = False,
+        on_game=None,
+        stop=None,
+        adjudicator: Adjudicator = None,
+        resignation: Resignation = None,
+    ):
+        """
+        Plays the given number of self-play games, keeping slots of them in progress
+        at once
+
+        Every slot searches its own position and plays its move as soon as its runs
+        are done, and a finished game hands its slot to the next one, so each forward
+        pass holds one leaf per slot until the last games are running. New roots are
+        expanded by the first pass their slot takes part in.
+
+        on_game is called with the training data of each game as it ends. Once the
+        event stop is set no more moves are played and unfinished games are dropped.
+        Slow terminal checks of the leaves go to adjudicator, and games end early as
+        resignation decides.
+        """
+        self.net = net
+        self.Board = Board
+        self.runs = runs
+        self.games = games
+        self.node_type = node_type
+        self.eval_cache = eval_cache
+        self.board_cache = board_cache
+        self.max_nodes = max_nodes
+        self.benchmark = benchmark
+        self.telemetry = telemetry
+        self.on_game = on_game
+        self.stop = stop
+        self.adjudicator = adjudicator
+        self.resignation = resignation
+        self.input_buffer = InputBuffer(slots)
+
+        self.started = 0
+        self.slots = [self.new_game() for _ in range(min(slots, games))]
+        self.results = {}  # game -> (result, boards, pis, idxs)
+
+    def new_game(self) -> GameSlot:
+        if self.started == self.games:
+            return None
+        self.started += 1
+        resign = None if self.resignation is None else self.resignation.start()
+        return GameSlot(
+            self.started - 1, self.Board.from_start(), self.node_type, self.runs, resign
+        )
+
+    def play(self):
+        """
+        returns training data of every finished game, the move indices of the first
+        game
+        """
+        st = time.time()
+        ppt = 0
+        passes = 0
+        leaves = 0
+        if self.telemetry:
+            pbar = tqdm(desc="SP - Games Played", total=self.games)
+
+        while len(self.results) < self.games:
+            if self.stop is not None and self.stop.is_set():
+                break
+            active = [i for i, slot in enumerate(self.slots) if slot is not None]
+            paths = []
+            sim_nodes = []
+            sim_boards = []
+            for i in active:
+                path = []
+                node = select(self.slots[i].tree, path)
+                paths.append(path)
+                sim_nodes.append(node)
+                sim_boards.append(get_board(node, self.board_cache))
+
+            ppts = time.time()
+            p_vecs, evals = parallel_pass(
+                sim_boards,
+                self.net,
+                self.eval_cache,
+                self.input_buffer,
+                self.adjudicator,
+            )
+            ppt += time.time() - ppts
+            passes += 1
+            leaves += len(active)
+
+            for j, i in enumerate(active):
+                slot = self.slots[i]
+                node = sim_nodes[j]
+                back_propagate_path(paths[j], evals[j])
+                if not np.any(np.isnan(p_vecs[j])) and node.is_leaf():
+                    node.make_children(
+                        add_dirichlet(np.array(p_vecs[j])), sim_boards[j]
+                    )
+                    slot.expanded += 1
+                if self.max_nodes:
+                    slot.tree, slot.expanded = enforce_node_budget(
+                        slot.tree, slot.expanded, self.max_nodes
+                    )
+
+                slot.runs -= 1
+                if slot.runs == 0:
+                    finished = self.play_move(slot)
+                    if finished:
+                        self.slots[i] = self.new_game()
+                        if self.telemetry:
+                            pbar.update(1)
+        et = time.time() - st
+
+        if self.benchmark and self.telemetry:
+            occupancy = leaves / (passes * len(self.slots)) if passes > 0 else 0.0
+            with open(BENCHMARK_FILE, "a") as f:
+                f.write(
+                    f"Scheduler: Games: {self.games}, Slots: {len(self.slots)}, Passes: {passes}, Mean Batch: {round(leaves / max(passes, 1), 1)}, Occupancy = {round(occupancy*100, 2)}%\n"
+                )
+                f.write(
+                    f"Total Time: {round(et, 3)}, Forward Time: {round(ppt, 3)}, F/T = {round(ppt/et*100, 2)}%\n"
+                )
+                append_to_recent_key("percent_forward", ppt / et * 100)
+                append_to_recent_key("slot_occupancy", occupancy)
+                if self.eval_cache is not None:
+                    write_eval_cache_stats(f, self.eval_cache)
+
+        training_data = []
+        for game in sorted(self.results):
+            result, boards, pis, _ = self.results[game]
+            training_data.extend(game_data(result, boards, pis))
+        idxs = self.results[0][3] if 0 in self.results else []
+        return training_data, idxs
+
+    def play_move(self, slot: GameSlot) -> bool:
+        """
+        Plays the best move of slot and reuses its subtree for the next search
+
+        returns whether the game is over
+        """
+        values, best = move_values(slot.tree)
+        child = slot.tree.child(best)
+        board = get_board(child, self.board_cache)
+        slot.boards.append(get_board(slot.tree, self.board_cache))
+        slot.pis.append(values)
+        slot.idxs.append(child.child_index)
+
+        result = board.terminal_eval()
+        if result == 2 and slot.resign is not None:
+            value = slot.tree.value_score()
+            result = self.resignation.update(slot.resign, value, len(slot.boards) - 1)
+        if result != 2:
+            if slot.resign is not None:
+                self.resignation.finish(slot.resign, result, len(slot.boards))
+            self.results[slot.game] = (result, slot.boards, slot.pis, slot.idxs)
+            if self.on_game is not None:
+                self.on_game(game_data(result, slot.boards, slot.pis))
+            slot.tree.release()
+            return True
+
+        slot.tree = child.promote()
+        slot.tree.board = board
+        slot.runs = max(self.runs - slot.tree.n, 3)
+        slot.expanded = len(expanded_nodes(slot.tree)) if self.max_nodes else 0
+        return False
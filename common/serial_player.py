@@ -2,6 +2,7 @@ import torch
 from tqdm import tqdm
 from common.board import BlankBoard
 from common.mcts import mcts
+from common.resignation import Resignation
 from common.training_player import TrainingPlayer
 from common.training_util import GameDataset, save_idxs
 import torch.nn as nn
@@ -20,13 +21,24 @@ class SerialPlayer(TrainingPlayer):
         multicore: int,
         Net: Type[nn.Module],
         Board: Type[BlankBoard],
+        resign_threshold=None,
+        resign_moves=5,
+        resign_playout=0.1,
     ):
         """
         Note: Multicore not used
+
+        resign_threshold, resign_moves and resign_playout end self-play games early as
+        in ParallelPlayer
         """
         super().__init__(
             mcts_iter, old_exists, SAVE_DIR, TEMP_NAME, multicore, Net, Board
         )
+        self.resignation = None
+        if resign_threshold is not None:
+            self.resignation = Resignation(
+                resign_threshold, resign_moves, resign_playout
+            )
 
     def generate_self_games(self, num):
         net = self.Net().to(device)
@@ -35,10 +47,14 @@ class SerialPlayer(TrainingPlayer):
                 torch.load(self.temp_name, map_location=torch.device(device))
             )
         net.eval()
+        if self.resignation is not None:
+            self.resignation.reset()
         all_data = []
         for _ in tqdm(range(num), desc="self play..."):
             data, idxs = self.play_a_game(net, net, self.mcts_iter, self_play=True)
             all_data.extend(data)
+        if self.resignation is not None:
+            print(self.resignation.summary(self.mcts_iter))
         return net, GameDataset(all_data), idxs
 
     def generate_eval_games(
@@ -83,7 +99,11 @@ class SerialPlayer(TrainingPlayer):
         pis = []
         idxs = []
         current_tree = None
-        while board.terminal_eval() == 2:
+        resign = None
+        if self_play and self.resignation is not None:
+            resign = self.resignation.start()
+        result = 2
+        while result == 2:
             if turn == 0:
                 move, pi, idx, current_tree = mcts(
                     board,
@@ -101,10 +121,16 @@ class SerialPlayer(TrainingPlayer):
             if track:
                 boards.append(board)
                 pis.append(pi)
+            if resign is not None:
+                value = current_tree.parent.value_score()
+                result = self.resignation.update(resign, value, len(idxs))
             board = move
             idxs.append(idx)
             turn = 1 if turn == 0 else 0
-        result = board.terminal_eval()
+            if result == 2:
+                result = board.terminal_eval()
+        if resign is not None:
+            self.resignation.finish(resign, result, len(idxs))
         if track:
             training_data = []
             for i in range(len(boards)):
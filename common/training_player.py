@@ -31,6 +31,7 @@ class TrainingPlayer:
         self.multicore = multicore
         self.Net = Net
         self.Board = Board
+        Board.use_save_dir(SAVE_DIR)
 
     @abstractmethod
     def generate_self_games(self, num):
@@ -25,6 +25,15 @@ class GameDataset(Dataset):
         return board, torch.tensor(pi), torch.tensor(z)
 
 
+def game_data(result, boards, pis) -> list:
+    """(board, pi, [reward]) of every move of a game, rewards from the mover's side"""
+    data = []
+    for j, (board, pi) in enumerate(zip(boards, pis)):
+        reward = result if j % 2 == 0 else -result
+        data.append((board, pi, [float(reward)]))
+    return data
+
+
 def save_idxs(SAVE_DIR, idxs, title="generic.npy"):
     fp = os.path.join(SAVE_DIR, title)
     np.save(fp, np.array(idxs))
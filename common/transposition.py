@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+
+class TranspositionTable:
+    def __init__(self, max_entries: int = 100000):
+        """
+        Maps BlankBoard.zobrist_hash() keys to expanded search nodes, so a position
+        reached through another move order reuses that node's subtree and value
+        instead of being expanded and evaluated again
+
+        Holds at most max_entries nodes, evicting the least recently used one
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key: int):
+        node = self.entries.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return node
+
+    def store(self, key: int, node):
+        self.entries[key] = node
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drops every entry (and the trees they keep alive), keeping the counters"""
+        self.entries.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate(),
+        }
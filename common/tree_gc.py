@@ -0,0 +1,92 @@
+import heapq
+import itertools
+
+from common.array_tree import ArrayNode
+
+EVICT_TO = 0.9  # fraction of the node budget left after an eviction, so it does not run every round
+
+
+def created_children(node) -> list:
+    if node.children is None:
+        return []
+    return [child for child in node.children if child is not None]
+
+
+def expanded_nodes(head) -> list:
+    """Every expanded node reachable from head, each once even when shared"""
+    nodes = []
+    seen = set()
+    stack = [head]
+    while stack:
+        node = stack.pop()
+        if node in seen or node.is_leaf():
+            continue
+        seen.add(node)
+        nodes.append(node)
+        stack.extend(created_children(node))
+    return nodes
+
+
+def evict_leaves(head, count: int, nodes: list = None) -> int:
+    """
+    Collapses up to count expanded nodes, least visited first, among those whose
+    children are all unexpanded. head itself is never collapsed.
+
+    The candidates are found once and kept in a heap; a parent joins it when the last
+    of its expanded children is collapsed.
+
+    returns the number of nodes collapsed
+    """
+    nodes = expanded_nodes(head) if nodes is None else nodes
+    parents = {node: [] for node in nodes}
+    pending = {}  # node -> expanded children it still has
+    for node in nodes:
+        expanded = [child for child in created_children(node) if not child.is_leaf()]
+        pending[node] = len(expanded)
+        for child in expanded:
+            parents[child].append(node)
+
+    order = itertools.count()  # ties are broken by insertion, never by comparing nodes
+    heap = [
+        (node.n, next(order), node)
+        for node in nodes
+        if node != head and pending[node] == 0
+    ]
+    heapq.heapify(heap)
+
+    evicted = 0
+    while evicted < count and heap:
+        _, _, node = heapq.heappop(heap)
+        node.collapse()
+        evicted += 1
+        for parent in parents[node]:
+            pending[parent] -= 1
+            if pending[parent] == 0 and parent != head:
+                heapq.heappush(heap, (parent.n, next(order), parent))
+    return evicted
+
+
+def tree_nbytes(head) -> int:
+    """Rough memory held by the tree under head, boards excluded"""
+    if isinstance(head, ArrayNode):
+        return head.nbytes()
+    return sum(node.nbytes() for node in expanded_nodes(head))
+
+
+def enforce_node_budget(head, expanded: int, max_nodes: int, compact: bool = True):
+    """
+    Evicts the least visited leaves once the tree holds more than max_nodes expanded
+    nodes, leaving about EVICT_TO of the budget. With compact set, the tree is then
+    rebuilt around head, which frees the evicted rows of an ArrayNode tree.
+
+    returns the (possibly new) head and its count of expanded nodes
+    """
+    if expanded <= max_nodes:
+        return head, expanded
+
+    nodes = expanded_nodes(head)
+    evicted = evict_leaves(head, len(nodes) - int(max_nodes * EVICT_TO), nodes)
+    expanded = len(nodes) - evicted
+    if compact:
+        head = head.promote()
+    return head, expanded
@@ -5,6 +5,11 @@ import torch
 from common.board import BlankBoard
 from scipy.signal import convolve2d
 
+# random 64 bit keys per (piece colour, column, row), XORed together by zobrist_hash
+_zobrist_rng = np.random.default_rng(seed=4)
+ZOBRIST_PIECES = _zobrist_rng.integers(0, 2**64, size=(2, 7, 6), dtype=np.uint64)
+ZOBRIST_RED_MOVE = int(_zobrist_rng.integers(0, 2**64, dtype=np.uint64))
+
 
 class BoardC4(BlankBoard):
     def __init__(self, board_matrix: np.ndarray, red_move: bool):
@@ -102,6 +107,21 @@ class BoardC4(BlankBoard):
             return torch.stack([t1, t0, tn1])
         return torch.stack([tn1, t0, t1])
 
+    def encode_into(self, out: torch.Tensor):
+        planes = out.numpy()
+        mine = 1 if self.red_move else -1
+        planes[0] = self.board_matrix == mine
+        planes[1] = self.board_matrix == 0
+        planes[2] = self.board_matrix == -mine
+
+    def zobrist_hash(self) -> int:
+        """Every move adds a piece, so a position can never repeat along a line of play"""
+        key = np.bitwise_xor.reduce(ZOBRIST_PIECES[0][self.board_matrix == 1])
+        key ^= np.bitwise_xor.reduce(ZOBRIST_PIECES[1][self.board_matrix == -1])
+        if self.red_move:
+            key ^= ZOBRIST_RED_MOVE
+        return int(key)
+
     def player_perspective_eval(self) -> int:
         terminal = self.terminal_eval()
 
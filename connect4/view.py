@@ -28,7 +28,7 @@ class C4Game(arcade.Window):
     def setup(self):
         self.board = BoardC4.from_start()
         self.result = 2
-        self.bot = MantisC4(self.fp)
+        self.bot = MantisC4(self.fp, ponder=True)
 
     def on_draw(self):
         self.clear()
@@ -101,6 +101,11 @@ class C4Game(arcade.Window):
 
     def on_mouse_press(self, x, y, button, key_modifiers):
         if self.result != 2:
+            self.bot.stop_pondering()
             arcade.Window.close(self)
         if 100 < x < 800:
             self.selected = (x - 100) // 100
+
+    def on_close(self):
+        self.bot.stop_pondering()
+        super().on_close()
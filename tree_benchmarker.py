@@ -0,0 +1,104 @@
+import resource
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from chess_standard.board_chess_pypi import BoardPypiChess, OUTPUT_LENGTH
+from common.array_tree import ArrayNode
+from common.mcts import Node, mcts
+from connect4.board_c4 import BoardC4
+
+# Compares the Node and ArrayNode tree backends of common.mcts on nodes/sec and peak RSS.
+# Every backend runs in its own spawned process, so ru_maxrss only sees that backend.
+
+BACKENDS = {"node": Node, "array": ArrayNode}
+GAMES = {"chess": (BoardPypiChess, OUTPUT_LENGTH), "c4": (BoardC4, 7)}
+
+
+class UniformNet(nn.Module):
+    """
+    Stand-in network with uniform priors and a zero value, so the benchmark
+    times the tree instead of the forward pass
+    """
+
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = outputs
+
+    def forward(self, x):
+        batch = x.shape[0]
+        return torch.full((batch, self.outputs), 1 / self.outputs), torch.zeros(
+            (batch, 1)
+        )
+
+
+def count_nodes(head) -> int:
+    """Root plus one node per legal move of every expanded node"""
+    if isinstance(head, ArrayNode):
+        return head.tree.size
+
+    count = 1
+    stack = [head]
+    while stack:
+        node = stack.pop()
+        if node.children is not None:
+            count += len(node.children)
+            stack.extend(child for child in node.children if child is not None)
+    return count
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(backend, game, runs, queue):
+    Board, outputs = GAMES[game]
+    net = UniformNet(outputs)
+    board = Board.from_start()
+    start_rss = peak_rss_mb()
+
+    st = time.time()
+    with torch.no_grad():
+        _, _, _, child = mcts(board, net, runs=runs, node_type=BACKENDS[backend])
+    et = time.time() - st
+
+    nodes = count_nodes(child.parent)
+    queue.put(
+        {
+            "backend": backend,
+            "runs": runs,
+            "nodes": nodes,
+            "seconds": et,
+            "nodes_per_sec": nodes / et,
+            "sims_per_sec": runs / et,
+            "peak_rss_mb": peak_rss_mb(),
+            "search_rss_mb": peak_rss_mb() - start_rss,
+        }
+    )
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn")
+
+    GAME = "chess"
+    RUNS = [100, 1000]
+
+    for runs in RUNS:
+        for backend in BACKENDS:
+            queue = mp.Queue()
+            process = mp.Process(target=run_backend, args=(backend, GAME, runs, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+
+            print(
+                f"{GAME} {result['backend']:>5} runs={runs}: "
+                f"{result['nodes']} nodes in {np.round(result['seconds'], 2)}s, "
+                f"{np.round(result['nodes_per_sec'])} nodes/sec, "
+                f"{np.round(result['sims_per_sec'], 1)} sims/sec, "
+                f"peak RSS {np.round(result['peak_rss_mb'], 1)} MB "
+                f"(+{np.round(result['search_rss_mb'], 1)} MB during search)"
+            )